@@ -0,0 +1,200 @@
+"""
+    anviz_sync.aio
+    ~~~~~~~~~~~~~~
+
+    Asyncio Anviz device client, mirrors :class:`anviz_sync.anviz.Device`
+    so many devices can be polled concurrently from a single thread, see
+    :func:`poll_devices`. ``anviz-sync`` itself syncs devices from a thread
+    pool with the blocking client, as storing goes through the blocking
+    database session anyway.
+
+    :copyright: (c) 2014 by Augusto Roccasalva
+    :license: BSD, see LICENSE for more details.
+"""
+
+import asyncio
+
+from anviz_sync.anviz import (
+    HEADER_SIZE, CMD_GET_INFO, CMD_GET_DATETIME, CMD_SET_DATETIME,
+    CMD_GET_TCPIP_PARAMS, CMD_GET_RECORD_INFO, CMD_DOWNLOAD_RECORDS,
+    CMD_DOWNLOAD_STAFF_INFO, CMD_CLEAR_RECORDS, DeviceException, RecordBatch,
+    build_request, unpack_header, check_ret, crc16, page_requests,
+    RECORDS_PAGE, STAFF_PAGE, skip_records,
+    parse_datetime, datetime_args, parse_net_params, parse_record_info,
+    parse_records, parse_staff_info, clear_records_args, parse_cleared
+)
+
+
+class AsyncDevice(object):
+
+    def __init__(self, device_id, ip_addr, ip_port, timeout=None,
+                 records_page=None, staff_page=None):
+        self.device_id = device_id
+        self.ip_addr = ip_addr
+        self.ip_port = ip_port
+        self.timeout = timeout
+        self.records_page = records_page or RECORDS_PAGE
+        self.staff_page = staff_page or STAFF_PAGE
+        self._reader = self._writer = None
+        self._lock = None
+
+    async def check_connected(self):
+        if self._writer is None:
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.ip_addr, self.ip_port),
+                    self.timeout
+                )
+            except asyncio.TimeoutError:
+                raise DeviceException("Timed out connecting to %s:%d" %
+                                      (self.ip_addr, self.ip_port))
+
+    def _abort(self):
+        # drop a connection whose stream state is unknown
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+    async def close(self):
+        if self._writer is not None:
+            writer, self._reader, self._writer = self._writer, None, None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def __aenter__(self):
+        await self.check_connected()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _read(self, n):
+        try:
+            return await asyncio.wait_for(self._reader.readexactly(n),
+                                          self.timeout)
+        except asyncio.IncompleteReadError as err:
+            raise DeviceException("Short read: expected %d bytes, got %d" %
+                                  (n, len(err.partial)))
+        except asyncio.TimeoutError:
+            raise DeviceException("Timed out waiting for %d bytes" % n)
+
+    async def _get_response(self, cmd, args=[]):
+        req = build_request(self.device_id, cmd, args)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            await self.check_connected()
+            try:
+                self._writer.write(req)
+                await self._writer.drain()
+                header = await self._read(HEADER_SIZE)
+                ret, data_len = unpack_header(self.device_id, cmd, header)
+                rest = await self._read(data_len + 2)
+                if crc16(header + rest[:-2]) != rest[-2:]:
+                    raise DeviceException("Checksum error")
+            except BaseException:
+                # timeouts, short reads and cancellation leave the
+                # response half read, later commands would read garbage
+                self._abort()
+                raise
+        check_ret(ret)
+        return rest[:-2]
+
+    async def get_information(self):
+        return await self._get_response(CMD_GET_INFO)
+
+    async def get_datetime(self):
+        return parse_datetime(await self._get_response(CMD_GET_DATETIME))
+
+    async def set_datetime(self, dt):
+        res = await self._get_response(CMD_SET_DATETIME, datetime_args(dt))
+        return len(res) == 0
+
+    async def get_net_params(self):
+        return parse_net_params(
+            await self._get_response(CMD_GET_TCPIP_PARAMS)
+        )
+
+    async def get_record_info(self):
+        return parse_record_info(
+            await self._get_response(CMD_GET_RECORD_INFO)
+        )
+
+    async def _record_pages(self, new=False, clear=True):
+        info = await self.get_record_info()
+        if new:
+            total = info.new_records
+            param = 2
+        else:
+            total = info.all_records
+            param = 1
+        for args in page_requests(param, total, self.records_page):
+            yield await self._get_response(CMD_DOWNLOAD_RECORDS, args)
+        if new and clear:
+            await self.clear_records()
+
+    async def _skip_records(self, new, clear, skip):
+        async for data in self._record_pages(new, clear):
+            for page in skip_records([data], skip):
+                yield page
+            skip = max(0, skip - data[0])
+
+    async def download_records(self, new=False, clear=True, skip=0):
+        """Async generator version of
+        :meth:`anviz_sync.anviz.Device.download_records`.
+        """
+        async for data in self._skip_records(new, clear, skip):
+            for r in parse_records(data):
+                yield r
+
+    async def download_record_batches(self, new=False, clear=True, skip=0):
+        async for data in self._skip_records(new, clear, skip):
+            yield RecordBatch.from_page(data)
+
+    def download_all_records(self):
+        return self.download_records(new=False)
+
+    def download_new_records(self):
+        return self.download_records(new=True)
+
+    async def download_staff_info(self):
+        users = (await self.get_record_info()).users
+        staff = list()
+        for args in page_requests(1, users, self.staff_page):
+            data = await self._get_response(CMD_DOWNLOAD_STAFF_INFO, args)
+            staff.extend(parse_staff_info(data))
+        return staff
+
+    async def clear_records(self, amount=None):
+        args = clear_records_args(amount)
+        return parse_cleared(
+            await self._get_response(CMD_CLEAR_RECORDS, args)
+        )
+
+    def __repr__(self):
+        return '<AsyncDevice %d %s:%d>' % (self.device_id, self.ip_addr,
+                                           self.ip_port)
+
+
+async def poll_devices(devices, job, limit=8):
+    """Runs coroutine function ``job(device)`` for every device in
+    `devices`, at most `limit` at a time.
+
+    Returns a list with every job result in `devices` order, a failing job
+    gives its exception instead of a result.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(device):
+        async with semaphore:
+            try:
+                return await job(device)
+            finally:
+                await device.close()
+
+    return await asyncio.gather(*[run(d) for d in devices],
+                                return_exceptions=True)
+
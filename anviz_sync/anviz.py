@@ -4,9 +4,6 @@
 
     Anviz device abstraction, communication protocol and commands.
 
-    crc table & algorithm based on:
-    https://github.com/benperiton/anviz-protocol
-
     :copyright: (c) 2014 by Augusto Roccasalva
     :license: BSD, see LICENSE for more details.
 """
@@ -14,9 +11,16 @@
 import socket
 import struct
 import itertools
+import threading
+import time
+from contextlib import contextmanager
+from array import array
 from datetime import datetime
 from collections import namedtuple
 
+from anviz_sync import metrics
+from anviz_sync.crc import crc16, crc16_value
+
 # some constants
 STX = 0xa5
 ACK_sum = 0x80
@@ -59,44 +63,6 @@ CMD_SET_DEVICE_TYPE     = 0x49
 
 CMD_CLEAR_RECORDS       = 0x4e
 
-# crc16 bits
-_crc_table = (
-    0x0000,0x1189,0x2312,0x329b,0x4624,0x57ad,0x6536,0x74bf,0x8c48,0x9dc1,
-    0xaf5a,0xbed3,0xca6c,0xdbe5,0xe97e,0xf8f7,0x1081,0x0108,0x3393,0x221a,
-    0x56a5,0x472c,0x75b7,0x643e,0x9cc9,0x8d40,0xbfdb,0xae52,0xdaed,0xcb64,
-    0xf9ff,0xe876,0x2102,0x308b,0x0210,0x1399,0x6726,0x76af,0x4434,0x55bd,
-    0xad4a,0xbcc3,0x8e58,0x9fd1,0xeb6e,0xfae7,0xc87c,0xd9f5,0x3183,0x200a,
-    0x1291,0x0318,0x77a7,0x662e,0x54b5,0x453c,0xbdcb,0xac42,0x9ed9,0x8f50,
-    0xfbef,0xea66,0xd8fd,0xc974,0x4204,0x538d,0x6116,0x709f,0x0420,0x15a9,
-    0x2732,0x36bb,0xce4c,0xdfc5,0xed5e,0xfcd7,0x8868,0x99e1,0xab7a,0xbaf3,
-    0x5285,0x430c,0x7197,0x601e,0x14a1,0x0528,0x37b3,0x263a,0xdecd,0xcf44,
-    0xfddf,0xec56,0x98e9,0x8960,0xbbfb,0xaa72,0x6306,0x728f,0x4014,0x519d,
-    0x2522,0x34ab,0x0630,0x17b9,0xef4e,0xfec7,0xcc5c,0xddd5,0xa96a,0xb8e3,
-    0x8a78,0x9bf1,0x7387,0x620e,0x5095,0x411c,0x35a3,0x242a,0x16b1,0x0738,
-    0xffcf,0xee46,0xdcdd,0xcd54,0xb9eb,0xa862,0x9af9,0x8b70,0x8408,0x9581,
-    0xa71a,0xb693,0xc22c,0xd3a5,0xe13e,0xf0b7,0x0840,0x19c9,0x2b52,0x3adb,
-    0x4e64,0x5fed,0x6d76,0x7cff,0x9489,0x8500,0xb79b,0xa612,0xd2ad,0xc324,
-    0xf1bf,0xe036,0x18c1,0x0948,0x3bd3,0x2a5a,0x5ee5,0x4f6c,0x7df7,0x6c7e,
-    0xa50a,0xb483,0x8618,0x9791,0xe32e,0xf2a7,0xc03c,0xd1b5,0x2942,0x38cb,
-    0x0a50,0x1bd9,0x6f66,0x7eef,0x4c74,0x5dfd,0xb58b,0xa402,0x9699,0x8710,
-    0xf3af,0xe226,0xd0bd,0xc134,0x39c3,0x284a,0x1ad1,0x0b58,0x7fe7,0x6e6e,
-    0x5cf5,0x4d7c,0xc60c,0xd785,0xe51e,0xf497,0x8028,0x91a1,0xa33a,0xb2b3,
-    0x4a44,0x5bcd,0x6956,0x78df,0x0c60,0x1de9,0x2f72,0x3efb,0xd68d,0xc704,
-    0xf59f,0xe416,0x90a9,0x8120,0xb3bb,0xa232,0x5ac5,0x4b4c,0x79d7,0x685e,
-    0x1ce1,0x0d68,0x3ff3,0x2e7a,0xe70e,0xf687,0xc41c,0xd595,0xa12a,0xb0a3,
-    0x8238,0x93b1,0x6b46,0x7acf,0x4854,0x59dd,0x2d62,0x3ceb,0x0e70,0x1ff9,
-    0xf78f,0xe606,0xd49d,0xc514,0xb1ab,0xa022,0x92b9,0x8330,0x7bc7,0x6a4e,
-    0x58d5,0x495c,0x3de3,0x2c6a,0x1ef1,0x0f78
-)
-
-def crc16(data):
-    crc = 0xffff
-    for b in data:
-        crc = crc ^ b
-        crc = (crc >> 8) ^ _crc_table[crc & 0xff]
-    return struct.pack("<H", crc)
-
-
 def build_request(device_id, cmd, data=b''):
     req = bytearray([STX])
     req.extend(struct.pack(">L", device_id))
@@ -145,131 +111,587 @@ def split_every(n, iterator, conv=list):
         yield piece
         piece = conv(itertools.islice(it, n))
 
+# code (5 bytes), seconds, bkp, type, work (3 bytes)
+_record = struct.Struct(">BIIBBBH")
+RECORD_SIZE = _record.size
+
+_columns = ('code', 'sec', 'bkp', 'type', 'work')
+_column_types = {'code': 'Q', 'sec': 'I', 'bkp': 'B', 'type': 'B', 'work': 'I'}
+
+_numpy_module = False
+
+def _numpy():
+    """Returns :mod:`numpy`, imported on first use, or None when it isn't
+    installed. Keeps it out of the startup of commands not decoding records.
+    """
+    global _numpy_module, _record_dtype
+    if _numpy_module is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        else:
+            _record_dtype = numpy.dtype([
+                ('code_hi', 'u1'), ('code_lo', '>u4'), ('sec', '>u4'),
+                ('bkp', 'u1'), ('type', 'u1'), ('work_hi', 'u1'),
+                ('work_lo', '>u2'),
+            ])
+        _numpy_module = numpy
+    return _numpy_module
+
+
 def parse_record(data):
-    it = iter(data)
-    uid = struct.unpack(">Q", left_fill(b_take(it, 5), 8))[0]
-    sec = struct.unpack(">I", b_take(it, 4))[0]
-    bkp = struct.unpack("B", b_take(it, 1))[0]
-    rtype = struct.unpack("B", b_take(it, 1))[0]
-    wtype = struct.unpack(">I", left_fill(b_take(it, 3), 4))[0]
-    return Record(uid, datetime.fromtimestamp(SSEC + sec), bkp, rtype, wtype)
+    hi, lo, sec, bkp, rtype, whi, wlo = _record.unpack_from(data)
+    return Record(hi << 32 | lo, datetime.fromtimestamp(SSEC + sec),
+                  bkp, rtype, whi << 16 | wlo)
+
+
+def page_records(data):
+    """Returns a view over the raw records of a download page, checking
+    the leading valid records count.
+    """
+    view = memoryview(data)[1:]
+    if len(view) != data[0] * RECORD_SIZE:
+        raise DeviceException("Expected %d records in page, got %d bytes" %
+                              (data[0], len(view)))
+    return view
+
+
+def skip_records(pages, skip):
+    """Yields download pages from `pages` dropping the first `skip`
+    records. Whole pages are dropped without being parsed, a page holding
+    the boundary is sliced.
+    """
+    for data in pages:
+        if skip <= 0:
+            yield data
+            continue
+        count = data[0]
+        if skip >= count:
+            skip -= count
+            continue
+        yield bytes([count - skip]) + bytes(data[1 + skip * RECORD_SIZE:])
+        skip = 0
+
+
+def decode_records(buf):
+    """Yields ``(code, seconds, bkp, type, work)`` tuples from `buf`, any
+    concatenation of raw records (see :func:`page_records`), in one pass.
+    """
+    for hi, lo, sec, bkp, rtype, whi, wlo in _record.iter_unpack(buf):
+        yield hi << 32 | lo, sec, bkp, rtype, whi << 16 | wlo
+
+
+def decode_records_columns(buf):
+    """Decodes raw records in `buf` into columns.
+
+    Returns a dict with ``code``, ``sec``, ``bkp``, ``type`` and ``work``
+    columns, as NumPy arrays when available or :mod:`array` arrays
+    otherwise. ``sec`` holds seconds since :data:`SSEC`.
+    """
+    numpy = _numpy()
+    if numpy is not None:
+        raw = numpy.frombuffer(buf, dtype=_record_dtype)
+        return {
+            'code': raw['code_hi'].astype('u8') << 32 | raw['code_lo'],
+            'sec': raw['sec'].astype('u4'),
+            'bkp': raw['bkp'].copy(),
+            'type': raw['type'].copy(),
+            'work': raw['work_hi'].astype('u4') << 16 | raw['work_lo'],
+        }
+    columns = tuple(zip(*decode_records(buf))) or ((),) * len(_columns)
+    return dict(
+        (name, array(_column_types[name], column))
+        for name, column in zip(_columns, columns)
+    )
 
 
 def parse_records(data):
-    data = bytearray(data)
-    valids = data.pop(0)
-    records = list()
-    for rdata in split_every(14, data, bytes):
-        records.append(parse_record(rdata))
-    assert len(records) == valids
-    return records
+    return [
+        Record(code, datetime.fromtimestamp(SSEC + sec), bkp, rtype, work)
+        for code, sec, bkp, rtype, work in decode_records(page_records(data))
+    ]
+
+class RecordBatch(object):
+    """Columnar container of records.
+
+    Holds ``code``, ``sec``, ``bkp``, ``type`` and ``work`` columns as
+    returned by :func:`decode_records_columns`, datetimes are only built
+    when asked for.
+    """
+
+    def __init__(self, columns=None):
+        if columns is None:
+            columns = decode_records_columns(b'')
+        self.columns = columns
+
+    @classmethod
+    def from_page(cls, data):
+        """Builds a batch from a download records response payload."""
+        return cls(decode_records_columns(page_records(data)))
+
+    @classmethod
+    def concat(cls, batches):
+        """Joins `batches` into a single batch."""
+        batches = list(batches)
+        if len(batches) == 1:
+            return batches[0]
+        columns = {}
+        numpy = _numpy()
+        for name in _columns:
+            parts = [b.columns[name] for b in batches]
+            if numpy is not None and parts and \
+                    isinstance(parts[0], numpy.ndarray):
+                columns[name] = numpy.concatenate(parts)
+            else:
+                columns[name] = array(_column_types[name])
+                for part in parts:
+                    columns[name].extend(part)
+        return cls(columns)
+
+    def __len__(self):
+        return len(self.columns['code'])
+
+    def __iter__(self):
+        """Yields :class:`Record` tuples."""
+        for code, dt, bkp, rtype, work in zip(
+                self.column('code'), self.datetimes(), self.column('bkp'),
+                self.column('type'), self.column('work')):
+            yield Record(code, dt, bkp, rtype, work)
+
+    def column(self, name):
+        """Returns column `name` as a list of python ints."""
+        return self.columns[name].tolist()
+
+    def datetimes(self):
+        """Returns the records datetimes as a list."""
+        return [datetime.fromtimestamp(SSEC + sec)
+                for sec in self.column('sec')]
+
+    def __repr__(self):
+        return '<RecordBatch of %d records>' % len(self)
+
+
+# code (5 bytes), pwd (3), card (3), name (10), dep, group, mode, fp, special
+_staff = struct.Struct(">BL3s3s10sBBB2sB")
+STAFF_SIZE = _staff.size
+
+_no_value = b'\xff\xff\xff'
+
+
+def _staff_info(fields):
+    hi, lo, pwd, card, name, dep, group, mode, fp, special = fields
+    pwd = None if pwd == _no_value else int.from_bytes(pwd, 'big')
+    card = None if card == _no_value else int.from_bytes(card, 'big')
+    fp = struct.unpack("H", fp)[0]
+    return StaffInfo(hi << 32 | lo, pwd, card, name, dep, group, mode, fp,
+                     special)
 
 def parse_s_info(data):
+    return _staff_info(_staff.unpack_from(data))
+
+def parse_staff_info(data):
+    if len(data) - 1 != data[0] * STAFF_SIZE:
+        raise DeviceException("Expected %d users in page, got %d bytes" %
+                              (data[0], len(data) - 1))
+    return [_staff_info(fields) for fields in
+            _staff.iter_unpack(memoryview(data)[1:])]
+
+def parse_datetime(data):
+    y, m, d, h, mi, s = struct.unpack("B"*6, data)
+    return datetime(2000+y, m, d, h, mi, s)
+
+def datetime_args(dt):
+    assert isinstance(dt, datetime), "You must provide datetime argument"
+    return [dt.year-2000, dt.month, dt.day, dt.hour, dt.minute, dt.second]
+
+def parse_net_params(data):
     it = iter(data)
-    uid = struct.unpack(">Q", left_fill(b_take(it, 5), 8))[0]
-    pwd = b_take(it, 3)
-    if pwd == b'\xff\xff\xff':
-        pwd = None
-    else:
-        pwd = struct.unpack(">L", left_fill(pwd, 4))[0]
-    card = b_take(it, 3)
-    if card == b'\xff\xff\xff':
-        card = None
-    else:
-        card = struct.unpack(">L", left_fill(card, 4))[0]
-    name = b_take(it, 10)
-    dep = ord(b_take(it, 1))
-    group = ord(b_take(it, 1))
+    ip = ip_format(b_take(it, 4))
+    netmask = ip_format(b_take(it, 4))
+    mac = mac_format(b_take(it, 6))
+    gw = ip_format(b_take(it, 4))
+    server = ip_format(b_take(it, 4))
+    far = ord(b_take(it, 1))
+    com = struct.unpack("H", b_take(it, 2))[0]
     mode = ord(b_take(it, 1))
-    fp = struct.unpack("H", b_take(it, 2))[0]
-    special = ord(b_take(it, 1))
-    return StaffInfo(uid, pwd, card, name, dep, group, mode, fp, special)
+    dhcp = ord(b_take(it, 1))
+    return NetParams(ip, netmask, mac, gw, server, far, com, mode, dhcp)
+
+def parse_record_info(data):
+    # six 3 byte big endian counters
+    fields = struct.unpack(">" + "BH" * 6, data[:18])
+    return RecordsInfo(*[hi << 16 | lo for hi, lo in
+                         zip(fields[::2], fields[1::2])])
+
+def clear_records_args(amount=None):
+    # Only clear new record marks
+    if amount is None:
+        return [1] + list(b'\x00\x00\x00')
+    assert amount > 0
+    return [2] + list(struct.pack(">L", amount)[-3:])
+
+def parse_cleared(data):
+    return struct.unpack(">L", left_fill(data, 4))[0]
+
+#: records and staff info per download request by default, the documented
+#: A300 limits. Requests carry the count in a single byte.
+RECORDS_PAGE = 25
+STAFF_PAGE = 12
+
+def page_requests(param, total, page_size):
+    """Yields the arguments of every request needed to download `total`
+    items in pages of `page_size`, starting with `param`.
+    """
+    q = min([page_size, total])
+    yield [param, q]
+    left = total - q
+    while left > 0:
+        q = min([page_size, left])
+        yield [0, q]
+        left = left - q
 
-def parse_staff_info(data):
-    data = bytearray(data)
-    valids = data.pop(0)
-    info = list()
-    for sidata in split_every(27, data, bytes):
-        info.append(parse_s_info(sidata))
-    assert len(info) == valids
-    return info
 
 class DeviceException(Exception):
     pass
 
 
-class Device(object):
+class ConnectionLost(DeviceException):
+    """The connection with the device broke or timed out."""
+
+
+_header = struct.Struct(">BLBBH")
+HEADER_SIZE = _header.size
+
+
+def unpack_header(device_id, cmd, buf):
+    """Checks the response header in `buf` and returns its return code and
+    payload length.
+    """
+    stx, dev_id, ack, ret, data_len = _header.unpack_from(buf)
+    if stx != STX or dev_id != device_id or ack != cmd + ACK_sum:
+        raise DeviceException("Error in response")
+    return ret, data_len
+
+def check_ret(ret):
+    if ret != RET_SUCCESS:
+        raise DeviceException("Error in response (ret=0x%02x)" % ret)
+
+
+class FrameReader(object):
+    """Reads exactly framed responses from `sock` into a reusable buffer.
+
+    Every response is ``header + payload + crc``, where the header carries
+    the payload length. Bytes are read with ``recv_into`` until each part
+    is complete, so responses split over several TCP segments are handled.
+    """
+
+    def __init__(self, sock, bufsize=512):
+        self._sock = sock
+        self._buf = bytearray(bufsize)
+
+    def _read_into(self, start, n):
+        end = start + n
+        if end > len(self._buf):
+            self._buf.extend(bytes(end - len(self._buf)))
+        view = memoryview(self._buf)[start:end]
+        try:
+            pos = 0
+            while pos < n:
+                try:
+                    got = self._sock.recv_into(view[pos:])
+                except socket.timeout:
+                    raise ConnectionLost(
+                        "Timed out waiting for %d bytes" % (n - pos)
+                    )
+                if got == 0:
+                    raise ConnectionLost(
+                        "Short read: expected %d bytes, got %d" % (n, pos)
+                    )
+                pos += got
+        finally:
+            view.release()
+
+    def read_response(self, device_id, cmd):
+        """Reads a full response to `cmd` and returns its payload."""
+        self._read_into(0, HEADER_SIZE)
+        ret, data_len = unpack_header(device_id, cmd, self._buf)
+        end = HEADER_SIZE + data_len
+        self._read_into(HEADER_SIZE, data_len + 2)
+        with memoryview(self._buf) as mv:
+            if crc16(mv[:end]) != mv[end:end + 2]:
+                raise DeviceException("Checksum error")
+            data = bytes(mv[HEADER_SIZE:end])
+        check_ret(ret)
+        return data
+
+
+Frame = namedtuple("Frame", "device_id ack ret data")
+
+
+class FrameDecoder(object):
+    """Incremental decoder that splits a byte stream into validated frames.
+
+    Bytes are passed to :meth:`feed` as they arrive, in any chunking, and
+    every complete frame with a valid crc is returned. After garbage or a
+    corrupt frame the decoder resyncs on the next STX byte.
+
+    A candidate header is only trusted when its ack byte has the
+    :data:`ACK_sum` bit set and its length is at most `max_length`, keep
+    `max_length` as small as the expected frames so a stray STX can't
+    hold back the frames behind it for long.
+    """
+
+    def __init__(self, max_length=1024):
+        self.max_length = max_length
+        self._buf = bytearray()
+        #: valid frames decoded
+        self.frames = 0
+        #: frames discarded because of a crc mismatch
+        self.corrupt = 0
+        #: bytes discarded while looking for a frame start
+        self.dropped_bytes = 0
+
+    def feed(self, data):
+        buf = self._buf
+        buf.extend(data)
+        frames = []
+        pos = 0
+        while True:
+            start = buf.find(STX, pos)
+            if start < 0:
+                self.dropped_bytes += len(buf) - pos
+                pos = len(buf)
+                break
+            self.dropped_bytes += start - pos
+            pos = start
+            if len(buf) - pos < HEADER_SIZE:
+                break
+            stx, dev_id, ack, ret, length = _header.unpack_from(buf, pos)
+            if length > self.max_length or not ack & ACK_sum:
+                # not a real header, keep looking
+                self.dropped_bytes += 1
+                pos += 1
+                continue
+            end = pos + HEADER_SIZE + length
+            if len(buf) < end + 2:
+                break
+            if crc16_value(buf[pos:end]) != buf[end] | buf[end + 1] << 8:
+                self.corrupt += 1
+                pos += 1
+                continue
+            frames.append(Frame(dev_id, ack, ret,
+                                bytes(buf[pos + HEADER_SIZE:end])))
+            pos = end + 2
+        del buf[:pos]
+        self.frames += len(frames)
+        return frames
+
+    @property
+    def pending(self):
+        """Number of buffered bytes not yet decoded."""
+        return len(self._buf)
+
+
+#: commands that can safely be sent again after reconnecting
+_IDEMPOTENT = frozenset([
+    CMD_GET_INFO, CMD_GET_INFO_2, CMD_GET_DATETIME, CMD_GET_TCPIP_PARAMS,
+    CMD_GET_RECORD_INFO, CMD_GET_DEVICE_SN, CMD_GET_DEVICE_TYPE,
+])
+
+def _set_keepalive(sock, idle, interval=10, count=3):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval),
+                        ('TCP_KEEPCNT', count)):
+        if hasattr(socket, name):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
 
-    _connected = False
 
-    def __init__(self, device_id, ip_addr, ip_port):
+class Device(object):
+    """Anviz device reachable at `ip_addr`:`ip_port`.
+
+    The connection is opened on first use, or with :meth:`connect`, and
+    closed with :meth:`close` or by using the device as a context manager.
+    `connect_timeout` and `timeout` seconds bound connecting and every
+    read, pass ``timeout=None`` to wait for responses forever. TCP
+    keepalive probes start after `keepalive` idle seconds. A broken
+    connection, or one left with a rejected response, is dropped and
+    reopened on the next command, read only commands are retried up to
+    `reconnect_attempts` times with backoff.
+
+    `records_page` and `staff_page` set how many items each download
+    request asks for, :data:`RECORDS_PAGE` and :data:`STAFF_PAGE` by
+    default. With `pipeline` greater than one,
+    that many download requests are kept in flight instead of waiting a
+    full round trip for every page.
+
+    Every validated response payload is handed to `capture`, if given, as
+    ``capture.write(device_id, cmd, data, source)``, see
+    :class:`~anviz_sync.capture.CaptureWriter`. The source is `name`, or
+    ``ip:port`` when not named.
+    """
+
+    _s = _reader = None
+
+    def __init__(self, device_id, ip_addr, ip_port, timeout=30,
+                 records_page=None, staff_page=None, pipeline=1,
+                 connect_timeout=10, keepalive=60, reconnect_attempts=2,
+                 reconnect_delay=0.5, capture=None, name=None):
         self.device_id = device_id
         self.ip_addr = ip_addr
         self.ip_port = ip_port
-        self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+        self.records_page = records_page or RECORDS_PAGE
+        self.staff_page = staff_page or STAFF_PAGE
+        self.pipeline = pipeline
+        self.capture = capture
+        self.name = name
+
+    def _reset(self):
+        # drop a connection whose stream state is unknown
+        if self._s is not None:
+            self._s.close()
+        self._s = self._reader = None
+
+    def connect(self):
+        if self._s is not None:
+            return
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(self.connect_timeout)
+        try:
+            s.connect((self.ip_addr, self.ip_port))
+        except socket.timeout:
+            s.close()
+            raise ConnectionLost("Timed out connecting to %s:%d" %
+                                 (self.ip_addr, self.ip_port))
+        except OSError:
+            s.close()
+            raise
+        s.settimeout(self.timeout)
+        if self.keepalive:
+            _set_keepalive(s, self.keepalive)
+        self._s = s
+        self._reader = FrameReader(s)
 
     def check_connected(self):
-        if not self._connected:
-            self._s.connect((self.ip_addr, self.ip_port))
-            self._connected = True
+        self.connect()
 
-    def _get_response(self, cmd, args=[]):
+    @property
+    def connected(self):
+        return self._s is not None
+
+    @property
+    def source(self):
+        return self.name or '%s:%d' % (self.ip_addr, self.ip_port)
+
+    def close(self):
+        self._reset()
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _send(self, cmd, args=[]):
         req = build_request(self.device_id, cmd, args)
         self.check_connected()
-        self._s.send(req)
-        res = bytearray(self._s.recv(7))
-        if not check_response(self.device_id, cmd, res):
-            raise DeviceException("Error in response")
-        rlen = self._s.recv(2)
-        res.extend(rlen)
-        data_len = struct.unpack(">H", rlen)[0]
-        data = self._s.recv(data_len)
-        res.extend(data)
-        crc = self._s.recv(2)
-        if crc16(res) != crc:
-            raise DeviceException("Checksum error")
+        self._s.sendall(req)
+
+    def _read(self, cmd):
+        data = self._reader.read_response(self.device_id, cmd)
+        if self.capture is not None:
+            self.capture.write(self.device_id, cmd, data, self.source)
         return data
 
+    def _get_response(self, cmd, args=[]):
+        attempts = self.reconnect_attempts if cmd in _IDEMPOTENT else 0
+        delay = self.reconnect_delay
+        while True:
+            try:
+                stats = metrics.active
+                if stats is not None:
+                    start = time.perf_counter()
+                self._send(cmd, args)
+                data = self._read(cmd)
+                if stats is not None:
+                    stats.command(cmd, time.perf_counter() - start,
+                                  HEADER_SIZE + len(data) + 2)
+                return data
+            except (ConnectionLost, OSError):
+                self._reset()
+                if attempts <= 0:
+                    raise
+                attempts -= 1
+                time.sleep(delay)
+                delay *= 2
+            except DeviceException:
+                # a rejected header leaves its payload unread, the next
+                # command would read it as its response
+                self._reset()
+                raise
+
+    def _pipelined(self, cmd, requests):
+        """Yields responses to every args list in `requests`, keeping up to
+        :attr:`pipeline` requests in flight.
+
+        On error the connection is reset, the device falls back to lock-step
+        requests and the error is raised, as the position of the device in
+        the download is lost.
+        """
+        requests = iter(requests)
+        in_flight = 0
+        stats = metrics.active
+        try:
+            for args in itertools.islice(requests, self.pipeline):
+                self._send(cmd, args)
+                in_flight += 1
+            if stats is not None:
+                last = time.perf_counter()
+            while in_flight:
+                data = self._read(cmd)
+                in_flight -= 1
+                if stats is not None:
+                    # time since the previous response, the per page cost
+                    # once the pipeline is full
+                    now = time.perf_counter()
+                    stats.command(cmd, now - last,
+                                  HEADER_SIZE + len(data) + 2)
+                    last = now
+                args = next(requests, None)
+                if args is not None:
+                    self._send(cmd, args)
+                    in_flight += 1
+                yield data
+        except (DeviceException, OSError):
+            self.pipeline = 1
+            self._reset()
+            raise
+
     def get_information(self):
         data = self._get_response(CMD_GET_INFO)
         return data
 
     def get_datetime(self):
-        data = self._get_response(CMD_GET_DATETIME)
-        y, m, d, h, mi, s = struct.unpack("B"*6, data)
-        return datetime(2000+y, m, d, h, mi, s)
+        return parse_datetime(self._get_response(CMD_GET_DATETIME))
 
     def set_datetime(self, dt):
-        assert isinstance(dt, datetime), "You must provide datetime argument"
-        args = [dt.year-2000, dt.month, dt.day, dt.hour, dt.minute, dt.second]
-        res = self._get_response(CMD_SET_DATETIME, args)
+        res = self._get_response(CMD_SET_DATETIME, datetime_args(dt))
         return len(res) == 0
 
 
     def get_net_params(self):
-        it = iter(self._get_response(CMD_GET_TCPIP_PARAMS))
-        ip = ip_format(b_take(it, 4))
-        netmask = ip_format(b_take(it, 4))
-        mac = mac_format(b_take(it, 6))
-        gw = ip_format(b_take(it, 4))
-        server = ip_format(b_take(it, 4))
-        far = ord(b_take(it, 1))
-        com = struct.unpack("H", b_take(it, 2))[0]
-        mode = ord(b_take(it, 1))
-        dhcp = ord(b_take(it, 1))
-        return NetParams(ip, netmask, mac, gw, server, far, com, mode, dhcp)
+        return parse_net_params(self._get_response(CMD_GET_TCPIP_PARAMS))
 
     def get_record_info(self):
-        it = iter(self._get_response(CMD_GET_RECORD_INFO))
-        users = sum(struct.unpack(">BH", b_take(it, 3)))
-        fp = sum(struct.unpack(">BH", b_take(it, 3)))
-        passwd = sum(struct.unpack(">BH", b_take(it, 3)))
-        card = sum(struct.unpack(">BH", b_take(it, 3)))
-        all_records = sum(struct.unpack(">BH", b_take(it, 3)))
-        new_records = sum(struct.unpack(">BH", b_take(it, 3)))
-        return RecordsInfo(users, fp, passwd, card, all_records, new_records)
-
-    def download_records(self, new=False):
+        return parse_record_info(self._get_response(CMD_GET_RECORD_INFO))
+
+    def _record_pages(self, new=False, clear=True):
         info = self.get_record_info()
         if new:
             total = info.new_records
@@ -277,19 +699,35 @@ class Device(object):
         else:
             total = info.all_records
             param = 1
-        q = min([25, total])
-        data = self._get_response(CMD_DOWNLOAD_RECORDS, [param, q])
-        for r in parse_records(data):
-            yield r
-        left = total - q
-        while left > 0:
-            q = min([25, left])
-            data = self._get_response(CMD_DOWNLOAD_RECORDS, [0, q])
+        requests = page_requests(param, total, self.records_page)
+        # the first request sets where the download starts, only the
+        # following ones may be pipelined
+        yield self._get_response(CMD_DOWNLOAD_RECORDS, next(requests))
+        for data in self._pipelined(CMD_DOWNLOAD_RECORDS, requests):
+            yield data
+        if new and clear:
+            self.clear_records()
+
+    def download_records(self, new=False, clear=True, skip=0):
+        """Yields device records, only new ones if `new` is set.
+
+        New record marks are cleared once every record was downloaded,
+        pass ``clear=False`` to call :meth:`clear_records` yourself after
+        the records were safely stored. The first `skip` records are still
+        transferred, the device can't seek, but dropped unparsed so an
+        interrupted download can be resumed cheaply.
+        """
+        pages = skip_records(self._record_pages(new, clear), skip)
+        for data in pages:
             for r in parse_records(data):
                 yield r
-            left = left - q
-        if new:
-            self.clear_records()
+
+    def download_record_batches(self, new=False, clear=True, skip=0):
+        """Like :meth:`download_records` but yields a :class:`RecordBatch`
+        for every downloaded page.
+        """
+        for data in skip_records(self._record_pages(new, clear), skip):
+            yield RecordBatch.from_page(data)
 
     def download_all_records(self):
         return self.download_records(new=False)
@@ -297,30 +735,83 @@ class Device(object):
     def download_new_records(self):
         return self.download_records(new=True)
 
-    def download_staff_info(self):
-        users = self.get_record_info().users
+    def staff_pages(self, users=None):
+        """Yields raw staff info pages, see :func:`parse_staff_info`.
+
+        `users` is the device user count, as given by
+        :meth:`get_record_info`, it's asked to the device if missing.
+        """
+        if users is None:
+            users = self.get_record_info().users
+        if users == 0:
+            return
+        requests = page_requests(1, users, self.staff_page)
+        yield self._get_response(CMD_DOWNLOAD_STAFF_INFO, next(requests))
+        for data in self._pipelined(CMD_DOWNLOAD_STAFF_INFO, requests):
+            yield data
+
+    def download_staff_info(self, users=None):
         staff = list()
-        q = min([12, users])
-        data = self._get_response(CMD_DOWNLOAD_STAFF_INFO, [1, q])
-        staff.extend(parse_staff_info(data))
-        left = users - q
-        while left > 0:
-            q = min([12, left])
-            data = self._get_response(CMD_DOWNLOAD_STAFF_INFO, [0, q])
+        for data in self.staff_pages(users):
             staff.extend(parse_staff_info(data))
-            left = left - q
         return staff
 
     def clear_records(self, amount=None):
-        # Only clear new record marks
-        if amount is None:
-            args = [1] + list(b'\x00\x00\x00')
-        else:
-            assert amount > 0
-            args = [2] + list(struct.pack(">L", amount)[-3:])
-        data = self._get_response(CMD_CLEAR_RECORDS, args)
-        cancelled = struct.unpack(">L", left_fill(data, 4))[0]
-        return cancelled
+        args = clear_records_args(amount)
+        return parse_cleared(self._get_response(CMD_CLEAR_RECORDS, args))
+
+
+class DevicePool(object):
+    """Process wide pool of idle connected devices keyed by
+    ``(ip_addr, ip_port, device_id)``, so repeated syncs skip the TCP
+    handshake. Idle devices older than `max_idle_time` seconds are closed
+    instead of reused.
+    """
+
+    def __init__(self, max_idle_time=300):
+        self.max_idle_time = max_idle_time
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def device(self, device_id, ip_addr, ip_port, **options):
+        """Context manager giving a device for exclusive use, `options`
+        only apply to newly created devices. The device is returned to the
+        pool on success and closed on error.
+        """
+        key = (ip_addr, ip_port, device_id)
+        dev = self._take(key)
+        if dev is None:
+            dev = Device(device_id, ip_addr, ip_port, **options)
+        try:
+            yield dev
+        except BaseException:
+            dev.close()
+            raise
+        if dev.connected:
+            with self._lock:
+                self._idle.setdefault(key, []).append((dev, time.time()))
+
+    def _take(self, key):
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                dev, since = idle.pop()
+                if time.time() - since <= self.max_idle_time:
+                    return dev
+                dev.close()
+        return None
+
+    def close_all(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for dev, _ in idle:
+                    dev.close()
+            self._idle.clear()
+
+
+#: default process wide pool
+pool = DevicePool()
 
 
 if __name__ == '__main__':
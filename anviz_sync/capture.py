@@ -0,0 +1,225 @@
+"""
+    anviz_sync.capture
+    ~~~~~~~~~~~~~~~~~~
+
+    Binary log of raw device responses, so downloads can be parsed and
+    stored again without pulling them from the devices.
+
+    A :class:`CaptureWriter` given to :class:`~anviz_sync.anviz.Device`
+    appends every validated response payload with the time it was received,
+    the device it came from and the command code. Devices are told apart by
+    their source, the configured device name or their ``ip:port``, as
+    device ids are often left at the factory default. A
+    :class:`CaptureReader` memory maps the log and feeds the captured pages
+    to :func:`parse_records`, :class:`RecordBatch` and
+    :func:`parse_staff_info` at disk speed.
+
+    The file starts with :data:`MAGIC`, entries follow as a header, the
+    source, the payload and a crc32 of all of them. An entry torn by a crash
+    is ignored when reading and truncated when the log is opened again for
+    writing.
+
+    :copyright: (c) 2014 by Augusto Roccasalva.
+    :license: BSD, see LICENSE for more details.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+from anviz_sync.anviz import (
+    CMD_DOWNLOAD_RECORDS, CMD_DOWNLOAD_STAFF_INFO, RecordBatch,
+    parse_records, parse_staff_info
+)
+
+MAGIC = b'ANVZCAP\x02'
+
+#: received (unix time), device id, command, payload length, source length
+_header = struct.Struct("<dLBHB")
+_crc = struct.Struct("<L")
+HEADER_SIZE = _header.size
+
+CaptureEntry = namedtuple("CaptureEntry",
+                          "received source device_id cmd data")
+
+
+class CaptureError(Exception):
+    pass
+
+
+def _entry_size(buf, offset):
+    length, source_len = _header.unpack_from(buf, offset)[3:]
+    return HEADER_SIZE + source_len + length + _crc.size
+
+
+def _valid(buf, offset, size):
+    end = offset + size - _crc.size
+    return zlib.crc32(buf[offset:end]) == _crc.unpack_from(buf, end)[0]
+
+
+def _scan(buf):
+    """Returns the end of the last intact entry in `buf`.
+
+    Entries are walked by their length, only the last one is checked
+    against its crc, a torn write may have left it partially written.
+    """
+    offset = last = len(MAGIC)
+    size = None
+    while offset + HEADER_SIZE <= len(buf):
+        end = offset + _entry_size(buf, offset)
+        if end > len(buf):
+            break
+        last, size, offset = offset, end - offset, end
+    if size is not None and not _valid(buf, last, size):
+        return last
+    return offset
+
+
+class CaptureWriter(object):
+    """Appends device responses to the capture log at `path`.
+
+    Meant to be set as the `capture` of one or more devices, entries are
+    written from any thread. Buffered entries reach the file on
+    :meth:`flush` and :meth:`close`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')
+        self._file.seek(0)
+        head = self._file.read(len(MAGIC))
+        if not head:
+            self._file.write(MAGIC)
+        elif head != MAGIC:
+            self._file.close()
+            raise CaptureError("%s is not a capture log" % path)
+        else:
+            self._truncate_torn()
+
+    def _truncate_torn(self):
+        self._file.seek(0)
+        data = self._file.read()
+        valid = _scan(data)
+        if valid != len(data):
+            self._file.truncate(valid)
+
+    def write(self, device_id, cmd, data, source='', received=None):
+        """Appends the response payload `data` to command `cmd` from
+        device `device_id` known as `source`.
+        """
+        if received is None:
+            received = time.time()
+        source = source.encode('utf-8')[:255]
+        head = _header.pack(received, device_id, cmd, len(data),
+                            len(source)) + source
+        crc = zlib.crc32(data, zlib.crc32(head))
+        with self._lock:
+            self._file.write(head)
+            self._file.write(data)
+            self._file.write(_crc.pack(crc))
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CaptureReader(object):
+    """Memory mapped view of the capture log at `path`.
+
+    Yielded payloads are memoryviews into the mapping, they must not be
+    kept past :meth:`close`. A trailing torn entry is ignored, any other
+    crc mismatch raises :class:`CaptureError`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < len(MAGIC):
+                raise CaptureError("%s is not a capture log" % path)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise CaptureError("%s is not a capture log" % path)
+
+    def entries(self, cmd=None, source=None):
+        """Yields :class:`CaptureEntry` tuples in capture order, only for
+        command `cmd` and device `source` when given.
+        """
+        buf = memoryview(self._mmap)
+        try:
+            offset = len(MAGIC)
+            end = _scan(buf)
+            while offset < end:
+                received, device_id, code, length, source_len = \
+                    _header.unpack_from(buf, offset)
+                size = _entry_size(buf, offset)
+                start = offset + HEADER_SIZE
+                name = bytes(buf[start:start + source_len]).decode(
+                    'utf-8', 'replace')
+                if (cmd is not None and code != cmd) or \
+                        (source is not None and name != source):
+                    offset += size
+                    continue
+                if not _valid(buf, offset, size):
+                    raise CaptureError("Corrupt entry at offset %d of %s" %
+                                       (offset, self.path))
+                start += source_len
+                offset += size
+                yield CaptureEntry(received, name, device_id, code,
+                                   buf[start:start + length])
+        finally:
+            buf.release()
+
+    def record_pages(self, source=None):
+        """Yields captured download records pages."""
+        for entry in self.entries(CMD_DOWNLOAD_RECORDS, source):
+            yield entry.data
+
+    def records(self, source=None):
+        """Yields ``(source, record)`` for every captured record."""
+        for entry in self.entries(CMD_DOWNLOAD_RECORDS, source):
+            for record in parse_records(entry.data):
+                yield entry.source, record
+
+    def record_batches(self, source=None):
+        """Yields a :class:`RecordBatch` for every captured records page."""
+        for data in self.record_pages(source):
+            yield RecordBatch.from_page(data)
+
+    def staff_info(self, source=None):
+        """Yields ``(source, staff)`` for every captured staff info."""
+        for entry in self.entries(CMD_DOWNLOAD_STAFF_INFO, source):
+            for staff in parse_staff_info(entry.data):
+                yield entry.source, staff
+
+    def sources(self):
+        """Returns the sources of the devices found in the capture."""
+        return sorted(set(entry.source for entry in self.entries()))
+
+    def close(self):
+        try:
+            self._mmap.close()
+        except BufferError:
+            # payloads still referenced, unmapped once they are released
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
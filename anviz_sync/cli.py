@@ -0,0 +1,130 @@
+"""
+    anviz_sync.cli
+    ~~~~~~~~~~~~~~
+
+    ``anviz-sync`` command line. Without a command the configured devices
+    are synced into the database, protocol only commands talk to the
+    devices without importing the database layer so they start fast::
+
+        anviz-sync [--all] [--staff] [--no-progress]
+        anviz-sync info [<name>...]
+        anviz-sync clock [--set] [<name>...]
+        anviz-sync dump [--new] [<name>...]
+        anviz-sync dump --replay <capture> [<name>...]
+
+    :copyright: (c) 2014 by Augusto Roccasalva.
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+from configparser import ConfigParser
+from datetime import datetime
+
+from anviz_sync.anviz import Device, DeviceException
+from anviz_sync.config import device_addresses, load_devices, replay_path
+
+
+def _devices(names):
+    config = ConfigParser()
+    config.read('anviz-sync.ini')
+    devices = load_devices(config)
+    if names:
+        devices = [dev for dev in devices if dev.name in names]
+    return devices
+
+
+def _each_device(argv, job):
+    # runs job(name, device) for every selected device, returns exit status
+    names = [arg for arg in argv if not arg.startswith('-')]
+    status = 0
+    for dev in _devices(names):
+        try:
+            with Device(dev.device_id, dev.ip_addr, dev.ip_port,
+                        timeout=dev.timeout, records_page=dev.records_page,
+                        pipeline=dev.pipeline,
+                        connect_timeout=dev.connect_timeout) as clock:
+                job(dev.name, clock)
+        except (DeviceException, OSError) as err:
+            sys.stderr.write("%s: error: %s\n" % (dev.name, err))
+            status = 1
+    return status
+
+
+def info(argv):
+    """Shows the record information of every device."""
+    def job(name, clock):
+        info = clock.get_record_info()
+        print("%s: %d users, %d records, %d new" %
+              (name, info.users, info.all_records, info.new_records))
+    return _each_device(argv, job)
+
+
+def clock(argv):
+    """Shows the device clocks and their drift, ``--set`` sets them to the
+    local time.
+    """
+    def job(name, clock):
+        if '--set' in argv:
+            clock.set_datetime(datetime.now().replace(microsecond=0))
+        dt = clock.get_datetime()
+        drift = (dt - datetime.now()).total_seconds()
+        print("%s: %s (%+.0fs)" % (name, dt, drift))
+    return _each_device(argv, job)
+
+
+def _write_record(out, name, r):
+    out.write("%s\t%d\t%s\t%d\t%d\t%d\n" %
+              (name, r.code, r.datetime.isoformat(), r.bkp, r.type, r.work))
+
+
+def _replay(argv):
+    # dumps the records of a capture log, named as they were captured
+    from anviz_sync.capture import CaptureReader
+    path = replay_path(argv)
+    if path is None:
+        sys.stderr.write("usage: anviz-sync dump --replay <capture> "
+                         "[<name>...]\n")
+        return 2
+    selected = [arg for arg in argv
+                if not arg.startswith('-') and arg != path]
+    config = ConfigParser()
+    config.read('anviz-sync.ini')
+    names = device_addresses(config)
+    with CaptureReader(path) as reader:
+        for source, r in reader.records():
+            name = names.get(source, source)
+            if not selected or name in selected:
+                _write_record(sys.stdout, name, r)
+    return 0
+
+
+def dump(argv):
+    """Writes device records as tab separated lines, ``--new`` only new
+    ones. New record marks are left untouched. With ``--replay <path>``
+    records are read from a capture log instead of the devices.
+    """
+    if '--replay' in argv:
+        return _replay(argv)
+
+    def job(name, clock):
+        for r in clock.download_records(new='--new' in argv, clear=False):
+            _write_record(sys.stdout, name, r)
+    return _each_device(argv, job)
+
+
+COMMANDS = {
+    'info': info,
+    'clock': clock,
+    'dump': dump,
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        sys.exit(COMMANDS[argv[0]](argv[1:]))
+    from anviz_sync import sync
+    sync.main(argv)
+
+
+if __name__ == '__main__':
+    main()
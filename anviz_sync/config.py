@@ -0,0 +1,74 @@
+"""
+    anviz_sync.config
+    ~~~~~~~~~~~~~~~~~
+
+    Helpers to read ``anviz-sync.ini`` shared by every entry point.
+
+    :copyright: (c) 2014 by Augusto Roccasalva.
+    :license: BSD, see LICENSE for more details.
+"""
+from collections import namedtuple
+
+DeviceConfig = namedtuple("DeviceConfig",
+                          "name device_id ip_addr ip_port timeout retries "
+                          "records_page staff_page pipeline connect_timeout "
+                          "keepalive")
+
+
+def _page_size(config, section, option):
+    # requests carry the page size in a single byte
+    value = config.getint(section, option, fallback=None)
+    if value is not None and not 1 <= value <= 255:
+        raise ValueError("%s in [%s] must be between 1 and 255, got %d" %
+                         (option, section, value))
+    return value
+
+
+def load_devices(config):
+    """Reads the device inventory from `config`.
+
+    Every ``[anviz:<name>]`` section describes a device named `name`, a
+    plain ``[anviz]`` section is read as a device named ``anviz``.
+    """
+    devices = []
+    for section in config.sections():
+        if section == 'anviz':
+            name = section
+        elif section.startswith('anviz:'):
+            name = section[len('anviz:'):]
+        else:
+            continue
+        devices.append(DeviceConfig(
+            name=name,
+            device_id=config.getint(section, 'device_id'),
+            ip_addr=config.get(section, 'ip_addr'),
+            ip_port=config.getint(section, 'ip_port'),
+            timeout=config.getfloat(section, 'timeout', fallback=30),
+            retries=config.getint(section, 'retries', fallback=2),
+            records_page=_page_size(config, section, 'records_page'),
+            staff_page=_page_size(config, section, 'staff_page'),
+            pipeline=config.getint(section, 'pipeline', fallback=1),
+            connect_timeout=config.getfloat(section, 'connect_timeout',
+                                            fallback=10),
+            keepalive=config.getint(section, 'keepalive', fallback=60),
+        ))
+    return devices
+
+
+def device_names(config):
+    """Returns a dict mapping configured device ids to device names."""
+    return dict((dev.device_id, dev.name) for dev in load_devices(config))
+
+
+def device_addresses(config):
+    """Returns a dict mapping configured ``ip:port`` to device names."""
+    return dict(('%s:%d' % (dev.ip_addr, dev.ip_port), dev.name)
+                for dev in load_devices(config))
+
+
+def replay_path(argv):
+    """Returns the path following ``--replay`` in `argv`, or None."""
+    index = argv.index('--replay') + 1
+    if index < len(argv) and not argv[index].startswith('-'):
+        return argv[index]
+    return None
@@ -0,0 +1,332 @@
+"""
+    anviz_sync.metrics
+    ~~~~~~~~~~~~~~~~~~
+
+    Optional instrumentation of device commands and sync phases.
+
+    Instrumentation is off until :func:`enable` is called, hooks then only
+    cost a global lookup. Collected metrics are handed to sinks writing a
+    log line, a JSON file or serving a Prometheus text endpoint, see
+    :func:`from_config`.
+
+    :copyright: (c) 2014 by Augusto Roccasalva.
+    :license: BSD, see LICENSE for more details.
+"""
+import bisect
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+#: latency histogram upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+#: the enabled :class:`Metrics`, None when instrumentation is disabled
+active = None
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile `q`."""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS + (float('inf'),), self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'],
+                                    self.buckets))}
+
+
+class Metrics(object):
+    """Thread safe collection of command, phase and counter metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sinks = []
+        #: per command code: requests, bytes and latency
+        self.commands = {}
+        #: per phase: time spent and records handled
+        self.phases = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def command(self, cmd, seconds, nbytes):
+        with self._lock:
+            stats = self.commands.get(cmd)
+            if stats is None:
+                stats = self.commands[cmd] = {'requests': 0, 'bytes': 0,
+                                              'latency': Histogram()}
+            stats['requests'] += 1
+            stats['bytes'] += nbytes
+            stats['latency'].observe(seconds)
+
+    def add_phase(self, name, seconds, records=0):
+        with self._lock:
+            stats = self.phases.get(name)
+            if stats is None:
+                stats = self.phases[name] = {'seconds': 0.0, 'records': 0,
+                                             'latency': Histogram()}
+            stats['seconds'] += seconds
+            stats['records'] += records
+            stats['latency'].observe(seconds)
+
+    @contextmanager
+    def phase(self, name, records=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start, records)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """Returns every metric as a JSON serializable dict."""
+        with self._lock:
+            commands = dict(
+                ('0x%02x' % cmd, {'requests': s['requests'],
+                                  'bytes': s['bytes'],
+                                  'latency': s['latency'].to_dict()})
+                for cmd, s in self.commands.items()
+            )
+            phases = dict(
+                (name, {'seconds': s['seconds'], 'records': s['records'],
+                        'records_per_second': s['records'] / s['seconds']
+                        if s['seconds'] else 0.0,
+                        'latency': s['latency'].to_dict()})
+                for name, s in self.phases.items()
+            )
+            return {'started': self.started, 'commands': commands,
+                    'phases': phases, 'counters': dict(self.counters)}
+
+    def flush(self):
+        """Hands the current metrics to every sink."""
+        for sink in self.sinks:
+            sink.emit(self)
+
+
+def enable():
+    """Enables instrumentation, returns the active :class:`Metrics`."""
+    global active
+    if active is None:
+        active = Metrics()
+    return active
+
+
+def disable():
+    global active
+    active = None
+
+
+class _NoPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_no_phase = _NoPhase()
+
+
+def phase(name, records=0):
+    """Context manager timing phase `name` when enabled."""
+    if active is None:
+        return _no_phase
+    return active.phase(name, records)
+
+
+def count(name, value=1):
+    if active is not None:
+        active.count(name, value)
+
+
+def timed(iterable, name):
+    """Iterates `iterable` adding the time spent producing every item, and
+    the item length as records, to phase `name` when enabled.
+    """
+    if active is None:
+        return iterable
+    return _timed(iterable, name, active)
+
+
+def _timed(iterable, name, stats):
+    it = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        stats.add_phase(name, time.perf_counter() - start, len(item))
+        yield item
+
+
+class LogSink(object):
+    """Writes a one line summary to `stream`."""
+
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+
+    def emit(self, metrics):
+        with metrics._lock:
+            line = self._format(metrics)
+        self.stream.write('metrics: %s\n' % line)
+        self.stream.flush()
+
+    def _format(self, metrics):
+        parts = []
+        for cmd, s in sorted(metrics.commands.items()):
+            latency = s['latency']
+            parts.append('cmd 0x%02x n=%d %dB avg=%.1fms p95<=%gms' % (
+                cmd, s['requests'], s['bytes'],
+                latency.sum / latency.count * 1000,
+                latency.quantile(0.95) * 1000))
+        for name, s in sorted(metrics.phases.items()):
+            part = '%s %.3fs' % (name, s['seconds'])
+            if s['records'] and s['seconds']:
+                part += ' %.0f rec/s' % (s['records'] / s['seconds'])
+            parts.append(part)
+        for name, value in sorted(metrics.counters.items()):
+            parts.append('%s=%d' % (name, value))
+        return ', '.join(parts)
+
+
+class JsonSink(object):
+    """Writes :meth:`Metrics.snapshot` to the file at `path`."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, metrics):
+        with open(self.path, 'w') as f:
+            json.dump(metrics.snapshot(), f, indent=2, sort_keys=True)
+
+
+def prometheus_text(metrics):
+    """Returns `metrics` in the Prometheus text exposition format."""
+    lines = []
+
+    def histogram(name, labels, h):
+        cumulative = 0
+        for bound, n in zip(BUCKETS + ('+Inf',), h.buckets):
+            cumulative += n
+            lines.append('%s_bucket{%s,le="%s"} %d' %
+                         (name, labels, bound, cumulative))
+        lines.append('%s_sum{%s} %f' % (name, labels, h.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, h.count))
+
+    with metrics._lock:
+        lines.append('# TYPE anviz_command_requests_total counter')
+        lines.append('# TYPE anviz_command_bytes_total counter')
+        lines.append('# TYPE anviz_command_seconds histogram')
+        for cmd, s in sorted(metrics.commands.items()):
+            labels = 'cmd="0x%02x"' % cmd
+            lines.append('anviz_command_requests_total{%s} %d' %
+                         (labels, s['requests']))
+            lines.append('anviz_command_bytes_total{%s} %d' %
+                         (labels, s['bytes']))
+            histogram('anviz_command_seconds', labels, s['latency'])
+        lines.append('# TYPE anviz_phase_records_total counter')
+        lines.append('# TYPE anviz_phase_seconds histogram')
+        for name, s in sorted(metrics.phases.items()):
+            labels = 'phase="%s"' % name
+            lines.append('anviz_phase_records_total{%s} %d' %
+                         (labels, s['records']))
+            histogram('anviz_phase_seconds', labels, s['latency'])
+        for name, value in sorted(metrics.counters.items()):
+            lines.append('# TYPE anviz_%s_total counter' % name)
+            lines.append('anviz_%s_total %d' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusSink(object):
+    """Serves live metrics at ``http://<addr>:<port>/metrics`` from a
+    daemon thread, meant for the long running ``anviz-rt``.
+    """
+
+    def __init__(self, addr='127.0.0.1', port=9105):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        self.metrics = None
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics' or sink.metrics is None:
+                    self.send_error(404)
+                    return
+                body = prometheus_text(sink.metrics).encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((addr, port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def emit(self, metrics):
+        self.metrics = metrics
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def from_config(config):
+    """Enables instrumentation when `config` has a ``[metrics]`` section,
+    returns the active :class:`Metrics` or None.
+
+    ``sinks`` lists the sinks to use: ``log``, ``json`` (written to
+    ``json_path``) and ``prometheus`` (served on ``prometheus_addr`` and
+    ``prometheus_port``).
+    """
+    if not config.has_section('metrics'):
+        return None
+    metrics = enable()
+    sinks = config.get('metrics', 'sinks', fallback='log')
+    for name in [s.strip() for s in sinks.split(',') if s.strip()]:
+        if name == 'log':
+            metrics.sinks.append(LogSink())
+        elif name == 'json':
+            metrics.sinks.append(JsonSink(
+                config.get('metrics', 'json_path', fallback='metrics.json')
+            ))
+        elif name == 'prometheus':
+            sink = PrometheusSink(
+                config.get('metrics', 'prometheus_addr',
+                           fallback='127.0.0.1'),
+                config.getint('metrics', 'prometheus_port', fallback=9105),
+            )
+            sink.emit(metrics)
+            metrics.sinks.append(sink)
+        else:
+            raise ValueError("Unknown metrics sink: %s" % name)
+    return metrics
@@ -1,5 +1,15 @@
 # -*- coding=utf-8 -*-
 
+"""
+    anviz_sync.models
+    ~~~~~~~~~~~~~~~~~
+
+    Database schema shared by ``anviz-sync`` and ``anviz-rt``.
+
+    :copyright: (c) 2014 by Augusto Roccasalva.
+    :license: BSD, see LICENSE for more details.
+"""
+
 from anviz_sync.saw import SQLAlchemy
 
 db = SQLAlchemy()
@@ -7,15 +17,138 @@ db = SQLAlchemy()
 
 class AttendanceRecord(db.Model):
     __tablename__ = "attendance_record"
+    __table_args__ = (
+        db.Index("ix_attendance_record_device_user_datetime",
+                 "device", "user_code", "datetime", unique=True),
+        db.Index("ix_attendance_record_datetime", "datetime"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    user_code = db.Column(db.Integer, nullable=False)
-    datetime = db.Column(db.DateTime, nullable=False, unique=True)
+    # device user codes take 40 bits
+    user_code = db.Column(db.BigInteger, nullable=False)
+    datetime = db.Column(db.DateTime, nullable=False)
     bkp_type = db.Column(db.Integer, nullable=False)
     type_code = db.Column(db.Integer, nullable=False)
     received = db.Column(db.DateTime)
     device = db.Column(db.String)
 
 
+class SyncState(db.Model):
+    __tablename__ = "sync_state"
+
+    device = db.Column(db.String(64), primary_key=True)
+    last_datetime = db.Column(db.DateTime)
+    record_count = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.DateTime)
+    #: records of an interrupted full download already stored
+    resume_offset = db.Column(db.Integer, default=0)
+    #: device user count and hashes of the staff pages last stored
+    staff_count = db.Column(db.Integer)
+    staff_hashes = db.Column(db.Text)
+    staff_updated = db.Column(db.DateTime)
+
+
+class Staff(db.Model):
+    """Staff info downloaded from a device, `page` is the download page
+    holding the user so pages can be replaced one at a time.
+    """
+    __tablename__ = "staff"
+
+    device = db.Column(db.String(64), primary_key=True)
+    code = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    page = db.Column(db.Integer, nullable=False, index=True)
+    #: raw name bytes as stored in the device
+    name = db.Column(db.LargeBinary(10))
+    card = db.Column(db.Integer)
+    dep = db.Column(db.Integer)
+    group = db.Column(db.Integer)
+    mode = db.Column(db.Integer)
+    fp = db.Column(db.Integer)
+    special = db.Column(db.Integer)
+
+
+_record_columns = ('user_code', 'datetime', 'bkp_type', 'type_code',
+                   'received', 'device')
+
+
 def configure_db(db_uri):
+    """Configures the shared `db` and brings its schema up to date.
+
+    Calling it again with the same `db_uri`, from another entry point in
+    the same process, reuses the same engine and connection pool.
+    """
     db.configure(db_uri)
+    db.create_all()
+    db.migrate()
+
+
+def existing_keys(codes, start, end, device=None):
+    """Returns the set of ``(user_code, datetime)`` pairs already stored for
+    `codes` between `start` and `end`, using a single query.
+
+    Rows from `device` and untagged rows (stored before devices were
+    tracked) are considered.
+    """
+    query = db.session.query(AttendanceRecord.user_code,
+                             AttendanceRecord.datetime)\
+                      .filter(AttendanceRecord.user_code.in_(codes))\
+                      .filter(AttendanceRecord.datetime.between(start, end))\
+                      .filter(db.or_(AttendanceRecord.device == device,
+                                     AttendanceRecord.device.is_(None)))
+    return set((code, dt) for code, dt in query)
+
+
+def insert_rows(rows):
+    """Bulk inserts ``(user_code, datetime, bkp_type, type_code, received,
+    device)`` tuples, rows already stored are ignored by the database.
+    Returns the number of inserted rows, see :meth:`SQLAlchemy.bulk_insert`.
+    """
+    return db.bulk_insert(AttendanceRecord, rows, columns=_record_columns,
+                          ignore_conflicts=True)
+
+
+def replace_staff_pages(device, pages, total):
+    """Replaces stored users of `device` download pages, `pages` maps page
+    numbers to lists of :class:`~anviz_sync.anviz.StaffInfo`. Users past
+    the first `total` pages are deleted.
+    """
+    Staff.query.filter(Staff.device == device,
+                       db.or_(Staff.page.in_(list(pages)),
+                              Staff.page >= total))\
+               .delete(synchronize_session=False)
+    db.add_all([Staff(device=device, code=s.code, page=page, name=s.name,
+                      card=s.card, dep=s.dep, group=s.group, mode=s.mode,
+                      fp=s.fp, special=s.special)
+                for page, staff in pages.items() for s in staff])
+
+
+def staff_names(device=None):
+    """Returns a dict mapping user codes to raw names from the stored
+    staff, of `device` only if given.
+    """
+    query = db.session.query(Staff.code, Staff.name)
+    if device is not None:
+        query = query.filter(Staff.device == device)
+    return dict(query)
+
+
+def store_events(events):
+    """Stores realtime `events`, ``(device, record, received)`` tuples,
+    skipping those already stored. Returns the number of inserted rows.
+    """
+    by_device = {}
+    for device, record, received in events:
+        by_device.setdefault(device, []).append((record, received))
+    rows = []
+    for device, items in by_device.items():
+        seen = existing_keys(set(r.code for r, _ in items),
+                             min(r.datetime for r, _ in items),
+                             max(r.datetime for r, _ in items), device)
+        for record, received in items:
+            key = (record.code, record.datetime)
+            if key in seen:
+                continue
+            seen.add(key)
+            rows.append((record.code, record.datetime, record.bkp,
+                         record.type, received, device))
+    return insert_rows(rows)
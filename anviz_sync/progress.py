@@ -11,6 +11,8 @@
 """
 
 import sys
+import time
+from datetime import datetime
 
 # Fancy progress ala (pacman-color) ArchLinux
 _colors = {
@@ -36,13 +38,57 @@ _colors = {
 _unset = object()
 
 
-class ProgressBar(object):
-    MAX_MARKERS = 27
+def format_rate(rate):
+    """Formats items per second in 7 columns."""
+    if rate >= 1e6:
+        return '%4.1fM/s' % (rate / 1e6)
+    if rate >= 1e4:
+        return '%4.1fk/s' % (rate / 1e3)
+    return '%5d/s' % rate
+
+
+def format_eta(seconds):
+    """Formats a duration as ``m:ss`` or ``h:mm:ss``."""
+    if seconds is None:
+        return '--:--'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+    return '%d:%02d' % (minutes, seconds)
+
+
+class _Rate(object):
+    # progress rate and estimated time left from the start of the job
+
+    def _start_clock(self):
+        self.started = time.time()
+
+    def rate(self):
+        elapsed = time.time() - self.started
+        return self.current_steps / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        rate = self.rate()
+        if not rate:
+            return None
+        return max(0, self.max_steps - self.current_steps) / rate
+
+
+class ProgressBar(_Rate):
+    """Terminal progress bar showing rate and time left.
+
+    Steps can be batched, ``step(n)`` once per page instead of once per
+    record, and the bar is redrawn at most every `min_interval` seconds so
+    terminal output never slows down the job itself.
+    """
+    MAX_MARKERS = 20
+    NAME_WIDTH = 30
     indicator = '\x1b[K%s%s%s\r'
     end_color = _colors['NORMAL']
 
     def __init__(self, name, max_steps, stream=sys.stdout,
-                 color='BOLD', sec_color='BLUE'):
+                 color='BOLD', sec_color='BLUE', min_interval=0.1):
         self.name = name
         self.start_color = _colors.get(color, _colors['NORMAL'])
         self.sec_start_color = _colors.get(sec_color, _colors['NORMAL'])
@@ -53,35 +99,38 @@ class ProgressBar(object):
         self.max_steps, self.current_steps = max_steps, 0
         self.steps_per_marker = float(max_steps) / self.MAX_MARKERS
         self.current_markers, self.current_percentage = 0, 0
+        self.min_interval = min_interval
+        self._drawn = 0.0
+        self._start_clock()
         self.set_activity(None)
 
     def set_activity(self, activity, color=None, flush=True):
         self.current_activity = activity
         self.act_color_name = color
         if flush:
-            self._stream.write(self.indicator % self._build_cols(
-                self.current_percentage, self.current_markers
-            ))
-            self._stream.flush()
+            self._draw()
 
     def step(self, step_increment = 1):
+        """Advances `step_increment` steps, ``step(0)`` forces a redraw."""
         self.current_steps += step_increment
+        if step_increment and self.current_steps < self.max_steps and \
+                time.time() - self._drawn < self.min_interval:
+            return
+        self._draw()
+
+    def _draw(self):
         if self.max_steps != 0:
-            new_markers = int(self.current_steps / self.steps_per_marker)
-            new_percentage = int(self.current_steps * 100 / self.max_steps)
+            steps = min(self.current_steps, self.max_steps)
+            self.current_markers = int(steps / self.steps_per_marker)
+            self.current_percentage = int(steps * 100 / self.max_steps)
         else:
-            new_markers = self.max_steps
-            new_percentage = 100
-
-        if (step_increment == 0) or\
-           (new_percentage != self.current_percentage) or\
-           (self.current_markers < new_markers):
-            self.current_percentage = new_percentage
-            self.current_markers = new_markers
-            self._stream.write(
-                self.indicator % self._build_cols(new_percentage, new_markers)
-            )
-            self._stream.flush()
+            self.current_markers = self.MAX_MARKERS
+            self.current_percentage = 100
+        self._stream.write(self.indicator % self._build_cols(
+            self.current_percentage, self.current_markers
+        ))
+        self._stream.flush()
+        self._drawn = time.time()
 
     def finish(self, msg=_unset, msg_color='normal'):
         if msg is not _unset:
@@ -93,8 +142,9 @@ class ProgressBar(object):
         self._stream.flush()
 
     def _build_cols(self, percentage, markers):
+        width = self.NAME_WIDTH
         if self.current_activity is None:
-            name = "%-42s" % self.name[:42]
+            name = "%-*s" % (width, self.name[:width])
             activity = ""
         else:
             if self.act_color_name is not None and\
@@ -105,22 +155,80 @@ class ProgressBar(object):
                     self.act_color = _colors['NORMAL']
 
             alen = len(self.current_activity)
-            nlen = 42 - alen
+            nlen = max(0, width - alen)
             name = ("%%-%ds" % nlen) % self.name[:nlen]
             activity = self.act_color + ("%%%ds" % alen) %\
                        self.current_activity + _colors['NORMAL']
 
         sc, ssc, ec = self.start_color, self.sec_start_color, self.end_color
         left = u"%s*%s %s%s%s %s [" % (ssc, ec, sc, name, ec, activity)
-        right = u"] %s%3d%%%s" % (sc, percentage, ec)
+        if percentage < 100:
+            speed = "ETA %s" % format_eta(self.eta())
+        else:
+            speed = "in %s" % format_eta(time.time() - self.started)
+        right = u"] %s%3d%%%s %s %s" % (sc, percentage, ec,
+                                        format_rate(self.rate()), speed)
         bar = (u'#'*markers+'-'*self.MAX_MARKERS)[:self.MAX_MARKERS]
         return left, bar, right
 
 
+class ProgressLog(_Rate):
+    """Progress reported as a plain log line every `interval` seconds, for
+    output that is not a terminal, like cron runs.
+    """
+
+    def __init__(self, name, max_steps, stream=sys.stdout, interval=10):
+        self.name = name
+        self.max_steps, self.current_steps = max_steps, 0
+        self.current_activity = None
+        self.interval = interval
+        self._stream = stream
+        self._start_clock()
+        self._logged = self.started
+
+    def set_activity(self, activity, color=None, flush=True):
+        self.current_activity = activity
+
+    def step(self, step_increment=1):
+        self.current_steps += step_increment
+        if time.time() - self._logged >= self.interval:
+            self._log("ETA %s" % format_eta(self.eta()))
+
+    def finish(self, msg=_unset, msg_color='normal'):
+        if msg is not _unset:
+            self.current_activity = msg
+        self._log("in %s" % format_eta(time.time() - self.started))
+
+    def _log(self, speed):
+        name = self.name
+        if self.current_activity:
+            name = '%s %s' % (name, self.current_activity)
+        percentage = (100 * self.current_steps // self.max_steps
+                      if self.max_steps else 100)
+        self._stream.write("[%s] %s: %d/%d %d%% %s %s\n" % (
+            datetime.now(), name, self.current_steps, self.max_steps,
+            percentage, format_rate(self.rate()).strip(), speed))
+        self._stream.flush()
+        self._logged = time.time()
+
+
+def progress_bar(name, max_steps, stream=sys.stdout):
+    """Returns a :class:`ProgressBar` when `stream` is a terminal or a
+    :class:`ProgressLog` otherwise.
+    """
+    isatty = getattr(stream, 'isatty', None)
+    if isatty is not None and isatty():
+        return ProgressBar(name, max_steps, stream)
+    return ProgressLog(name, max_steps, stream)
+
+
 class ProgressDummy(object):
 
     def set_activity(self, *args):
         pass
 
-    def step(self):
+    def step(self, step_increment=1):
+        pass
+
+    def finish(self, *args, **kwargs):
         pass
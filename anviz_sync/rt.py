@@ -10,14 +10,14 @@
     :license: BSD, see LICENSE for more details.
 """
 
-import socket
-import struct
+import asyncio
+from queue import Full
 from configparser import ConfigParser
 from datetime import datetime
 
-from anviz_sync import anviz
-from anviz_sync.models import AttendanceRecord, configure_db, db
-from anviz_sync.saw import SQLAlchemy
+from anviz_sync import anviz, metrics
+from anviz_sync.config import device_names
+from anviz_sync.spool import Spool
 
 
 TYPES = {
@@ -27,20 +27,135 @@ TYPES = {
 }
 
 
-def get_record(raw_data):
-    crc_ok = anviz.crc16(raw_data[:23]) == raw_data[-2:]
-    if not crc_ok:
-        raise ValueError("CRC verificaton failed")
-    stx, dev_id, ack, ret, length = struct.unpack(">BLBBH", raw_data[:9])
-    record = anviz.parse_record(raw_data[9 : 9 + length])
-    return dev_id, record
-
-
 def show_data(dev_id, record):
     time = datetime.now()
     print(
-        f"> dev_id={dev_id} user_id={record.code} {record.datetime.isoformat()} bkp={record.bkp} {TYPES[record.type]} work={record.work} [{time}]"
+        f"> dev_id={dev_id} user_id={record.code} {record.datetime.isoformat()} bkp={record.bkp} {TYPES.get(record.type, record.type)} work={record.work} [{time}]"
+    )
+
+
+def log(msg):
+    time = datetime.now()
+    print(f"[{time}] {msg}")
+
+
+async def handle_connection(reader, writer, queue, idle_timeout=None):
+    addr = writer.get_extra_info("peername")
+    log(f"Connected by {addr}")
+    # events carry a single record, a longer length is garbage
+    decoder = anviz.FrameDecoder(max_length=anviz.RECORD_SIZE)
+    try:
+        while True:
+            try:
+                data = await asyncio.wait_for(reader.read(65536), idle_timeout)
+            except asyncio.TimeoutError:
+                log(f"Idle timeout, closing {addr}")
+                break
+            if not data:
+                break
+            frames = decoder.feed(data)
+            metrics.count("rt_bytes", len(data))
+            metrics.count("rt_frames", len(frames))
+            for frame in frames:
+                if len(frame.data) != anviz.RECORD_SIZE:
+                    log(f"Discarding frame from {addr}: {frame}")
+                    continue
+                record = anviz.parse_record(frame.data)
+                # blocks this connection only when processing falls behind
+                await queue.put((frame.device_id, record, frame.data))
+    except ConnectionResetError:
+        log(f"Connection reset by {addr}")
+    finally:
+        writer.close()
+        metrics.count("rt_corrupt_frames", decoder.corrupt)
+        metrics.count("rt_pending_bytes", decoder.pending)
+    log(
+        f"Disconnected {addr} ({decoder.frames} frames, "
+        f"{decoder.corrupt} corrupt, {decoder.dropped_bytes} bytes dropped, "
+        f"{decoder.pending} bytes pending)"
+    )
+
+
+async def _put(writer, name, record, received):
+    try:
+        writer.put(name, record, received, block=False)
+    except Full:
+        # wait for the database off the event loop, this only holds back
+        # processing and, once the queue fills, the connections feeding it
+        metrics.count("rt_writer_full")
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, writer.put, name, record, received)
+
+
+async def process(queue, writer=None, names={}, spool=None):
+    while True:
+        dev_id, record, raw = await queue.get()
+        try:
+            show_data(dev_id, record)
+            if spool is not None:
+                # stored from the spool once synced to disk
+                spool.append(dev_id, raw, datetime.now().timestamp())
+            elif writer is not None:
+                await _put(writer, names.get(dev_id, str(dev_id)), record,
+                           datetime.now())
+        except Exception as err:
+            # a bad event must not stop the events queued behind it
+            log(f"Failed to process event from device {dev_id}: {err!r}")
+            metrics.count("rt_failed_events")
+        finally:
+            queue.task_done()
+
+
+async def sync_spool(spool, interval):
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(interval)
+        await loop.run_in_executor(None, spool.sync)
+
+
+async def flush_metrics(interval):
+    while True:
+        await asyncio.sleep(interval)
+        metrics.active.flush()
+
+
+async def serve(ip_addr, ip_port, idle_timeout=None, queue_size=1000,
+                writer=None, names={}, spool=None, fsync_interval=0.1,
+                metrics_interval=60):
+    """Listens for realtime events from any number of devices, feeding
+    them through a bounded queue to the processing stage.
+
+    When `writer` is given events are also stored through it, tagged with
+    the device name from `names` (device id to name) or the device id.
+    With a `spool` events are appended to it instead and synced to disk
+    every `fsync_interval` seconds, a :class:`~anviz_sync.writer.SpoolDrain`
+    stores them from there so a slow database never holds back the sockets.
+    Enabled metrics are flushed every `metrics_interval` seconds.
+    """
+    queue = asyncio.Queue(queue_size)
+    tasks = [asyncio.ensure_future(process(queue, writer, names, spool))]
+    if spool is not None:
+        tasks.append(asyncio.ensure_future(sync_spool(spool, fsync_interval)))
+    if metrics.active is not None:
+        tasks.append(asyncio.ensure_future(flush_metrics(metrics_interval)))
+    server = await asyncio.start_server(
+        lambda r, w: handle_connection(r, w, queue, idle_timeout),
+        ip_addr, ip_port, reuse_address=True
     )
+    log(f"Listening on {ip_addr}:{ip_port}")
+    try:
+        async with server:
+            tasks.append(asyncio.ensure_future(server.serve_forever()))
+            # background tasks run forever, one ending means events are no
+            # longer processed, stop instead of accepting events silently
+            done, _ = await asyncio.wait(tasks,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+            raise RuntimeError("Background task stopped: %r" % done.pop())
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 def main():
@@ -50,36 +165,48 @@ def main():
     # config device
     ip_addr = config.get("anviz-rt", "ip_addr")
     ip_port = config.getint("anviz-rt", "ip_port")
+    idle_timeout = config.getfloat("anviz-rt", "idle_timeout", fallback=None)
+    queue_size = config.getint("anviz-rt", "queue_size", fallback=1000)
+
+    # config db, events are only shown when not configured
+    writer = spool = None
+    names = device_names(config)
+    if config.has_option("sqlalchemy", "uri"):
+        # the database layer is only imported when storing events
+        from anviz_sync.models import configure_db
+        from anviz_sync.writer import RecordWriter, SpoolDrain
+        configure_db(config.get("sqlalchemy", "uri"))
+        batch_size = config.getint("anviz-rt", "commit_every", fallback=100)
+        interval = config.getint("anviz-rt", "commit_interval_ms",
+                                 fallback=500) / 1000.0
+        if config.has_option("anviz-rt", "spool_dir"):
+            spool = Spool(config.get("anviz-rt", "spool_dir"))
+            if spool.pending:
+                log(f"{spool.pending} spooled events pending")
+            drain = SpoolDrain(spool, names, batch_size, interval)
+            drain.start()
+        else:
+            writer = RecordWriter(batch_size=batch_size, interval=interval)
+            writer.start()
+    fsync_interval = config.getint("anviz-rt", "fsync_interval_ms",
+                                   fallback=100) / 1000.0
+    metrics.from_config(config)
+    metrics_interval = config.getfloat("metrics", "interval", fallback=60)
+
+    try:
+        asyncio.run(serve(ip_addr, ip_port, idle_timeout, queue_size,
+                          writer, names, spool, fsync_interval,
+                          metrics_interval))
+    except KeyboardInterrupt:
+        print("Quit")
+    finally:
+        if writer is not None:
+            writer.stop()
+        if spool is not None:
+            spool.sync()
+            drain.stop(timeout=30)
+            spool.close()
 
-    reconnect = True
-
-    while reconnect:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((ip_addr, ip_port))
-            s.listen()
-            conn, addr = s.accept()
-            with conn:
-                time = datetime.now()
-                print(f"[{time}] Connected by {addr}")
-                try:
-                    while True:
-                        data = conn.recv(1024)
-                        if not data:
-                            break
-                        dev_id, record = get_record(data)
-                        show_data(dev_id, record)
-                except ConnectionResetError as err:
-                    time = datetime.now()
-                    print(f"[{time}] Closing socket, reconnecting...")
-                    pass
-                except socket.timeout as err:
-                    time = datetime.now()
-                    print(f"[{time}] Reconnecting ...")
-                    pass
-                except KeyboardInterrupt as err:
-                    reconnect = False
-                    print("Quit")
 
 if __name__ == "__main__":
     main()
@@ -8,6 +8,7 @@
     :copyright: (c) 2014 by Augusto Roccasalva.
     :license: BSD, see LICENSE for more details.
 """
+import itertools
 import threading
 
 import sqlalchemy
@@ -17,11 +18,30 @@ from sqlalchemy.schema import MetaData
 from sqlalchemy import orm
 from sqlalchemy.orm.exc import UnmappedClassError
 
+class _Session(orm.Session):
+    """Session bound to the engine of `db` on first use, so no engine is
+    created until a connection is actually needed.
+    """
+
+    def __init__(self, db, **kwargs):
+        self._db = db
+        super(_Session, self).__init__(**kwargs)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        return self._db.engine
+
 def _create_scoped_session(db, query_cls):
-    session = orm.sessionmaker(autoflush=True, autocommit=False,
-                               query_cls=query_cls)
+    session = orm.sessionmaker(class_=_Session, db=db, autoflush=True,
+                               autocommit=False, query_cls=query_cls)
     return orm.scoped_session(session)
 
+def _chunks(iterable, size):
+    it = iter(iterable)
+    chunk = list(itertools.islice(it, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(it, size))
+
 def _tablemaker(db):
     def make_sa_table(*args, **kwargs):
         if len(args) > 1 and isinstance(args[1], db.Column):
@@ -30,13 +50,80 @@ def _tablemaker(db):
 
     return make_sa_table
 
-def _include_sqlalchemy(db):
+def _sqlalchemy_attr(name):
     for module in sqlalchemy, sqlalchemy.orm:
-        for key in module.__all__:
-            if not hasattr(db, key):
-                setattr(db, key, getattr(module, key))
-    db.Table = _tablemaker(db)
-    db.event = sqlalchemy.event
+        if name in module.__all__:
+            return getattr(module, name)
+    raise AttributeError(name)
+
+
+def _stale_uniques(inspector, table):
+    """Returns ``(kind, name, columns)`` for unique constraints and indexes
+    found in the database for `table` but not declared in its model.
+    """
+    declared = set()
+    for index in table.indexes:
+        if index.unique:
+            declared.add(tuple(c.name for c in index.columns))
+    for constraint in table.constraints:
+        if isinstance(constraint, (sqlalchemy.UniqueConstraint,
+                                   sqlalchemy.PrimaryKeyConstraint)):
+            declared.add(tuple(c.name for c in constraint.columns))
+    stale = []
+    for uc in inspector.get_unique_constraints(table.name):
+        if tuple(uc['column_names']) not in declared:
+            stale.append(('constraint', uc['name'], uc['column_names']))
+    names = set(name for _, name, _ in stale)
+    for ix in inspector.get_indexes(table.name):
+        if ix.get('unique') and ix['name'] not in names and \
+                'duplicates_constraint' not in ix and \
+                tuple(ix['column_names']) not in declared:
+            stale.append(('index', ix['name'], ix['column_names']))
+    return stale
+
+
+def _drop_unique(table, kind, name, columns):
+    """Returns the DDL dropping unique constraint or index `name` over
+    `columns` of `table`, as found by :func:`_stale_uniques`.
+
+    The constraint is built on a detached copy of the table, attaching it
+    to the model table would have it created again.
+    """
+    copy = sqlalchemy.Table(table.name, MetaData(),
+                            *[sqlalchemy.Column(c, sqlalchemy.Integer)
+                              for c in columns], schema=table.schema)
+    if kind == 'constraint':
+        return sqlalchemy.schema.DropConstraint(
+            sqlalchemy.UniqueConstraint(*copy.columns, name=name))
+    return sqlalchemy.schema.DropIndex(
+        sqlalchemy.Index(name, *copy.columns))
+
+
+def _narrow_columns(inspector, table):
+    """Returns the columns of `table` declared as big integers in its model
+    but found as smaller integers in the database.
+    """
+    found = dict((c['name'], c['type'])
+                 for c in inspector.get_columns(table.name))
+    return [column for column in table.columns
+            if isinstance(column.type, sqlalchemy.BigInteger) and
+            column.name in found and
+            isinstance(found[column.name], sqlalchemy.Integer) and
+            not isinstance(found[column.name], sqlalchemy.BigInteger)]
+
+
+def _widen_column(column, dialect):
+    """Returns the DDL changing the type of `column` in the database to its
+    model type, see :func:`_narrow_columns`.
+    """
+    preparer = dialect.identifier_preparer
+    table = preparer.format_table(column.table)
+    name = preparer.format_column(column)
+    type_ = column.type.compile(dialect=dialect)
+    if dialect.name == 'mysql':
+        return 'ALTER TABLE %s MODIFY %s %s%s' % (
+            table, name, type_, '' if column.nullable else ' NOT NULL')
+    return 'ALTER TABLE %s ALTER COLUMN %s TYPE %s' % (table, name, type_)
 
 
 class BaseQuery(orm.Query):
@@ -142,8 +229,17 @@ class SQLAlchemy(object):
         self.session = _create_scoped_session(self, query_cls=query_cls)
 
         self.Model = self.make_declarative_base()
-
-        _include_sqlalchemy(self)
+        self.Table = _tablemaker(self)
+        self.event = sqlalchemy.event
+
+    def __getattr__(self, name):
+        # sqlalchemy and sqlalchemy.orm names (db.Column, db.or_, ...) are
+        # looked up on first use and cached, instead of copying them all
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = _sqlalchemy_attr(name)
+        setattr(self, name, value)
+        return value
 
     def make_declarative_base(self):
         """Creates the declatative base."""
@@ -178,6 +274,10 @@ class SQLAlchemy(object):
 
     def configure(self, uri='sqlite://', app=None, echo=False, pool_size=None,
                   pool_timeout=None, pool_recycle=None, convert_unicode=True):
+        """Sets the database to connect to. The engine and its connection
+        pool are created on first use and shared while `uri` and `echo`
+        stay the same.
+        """
         self.uri = uri
         self.info = make_url(uri)
         self.options = self._cleanup_options(
@@ -187,8 +287,6 @@ class SQLAlchemy(object):
             pool_recycle = pool_recycle,
             convert_unicode = convert_unicode
         )
-        self.session.configure(bind=self.engine)
-        self.Model.metadata.bind = self.engine
 
     @property
     def engine(self):
@@ -235,10 +333,152 @@ class SQLAlchemy(object):
         """Proxy for session.rollback"""
         return self.session.rollback()
 
+    def bulk_insert(self, model, rows, columns=None, chunk_size=1000,
+                    ignore_conflicts=False):
+        """Inserts `rows` into `model` table without creating ORM objects.
+
+        `rows` may contain dicts or tuples, tuples are matched by position
+        against `columns` (by default every non primary key column). Rows
+        are sent in chunks of `chunk_size` using executemany within the
+        current session transaction. When `ignore_conflicts` is set, rows
+        violating a unique constraint are silently discarded by the
+        database where the dialect supports it, other dialects get a plain
+        insert. Returns the number of rows inserted, or sent when the driver
+        can't count rows of an executemany.
+        """
+        table = getattr(model, '__table__', model)
+        if columns is None:
+            columns = [c.name for c in table.columns if not c.primary_key]
+        stmt = self._insert_stmt(table, ignore_conflicts)
+        counted = self.engine.dialect.supports_sane_multi_rowcount
+        count = 0
+        for chunk in _chunks(rows, chunk_size):
+            params = [
+                row if isinstance(row, dict) else dict(zip(columns, row))
+                for row in chunk
+            ]
+            result = self.session.execute(stmt, params)
+            if counted and result.rowcount >= 0:
+                count += result.rowcount
+            else:
+                count += len(params)
+        return count
+
+    def _insert_stmt(self, table, ignore_conflicts=False):
+        if not ignore_conflicts:
+            return table.insert()
+        dialect = self.engine.dialect.name
+        if dialect == 'sqlite':
+            return table.insert().prefix_with('OR IGNORE')
+        elif dialect == 'mysql':
+            return table.insert().prefix_with('IGNORE')
+        elif dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            return insert(table).on_conflict_do_nothing()
+        # no portable way to ignore conflicts, callers dedup beforehand
+        return table.insert()
+
     def create_all(self):
         """Creates all tables."""
         self.Model.metadata.create_all(bind=self.engine)
 
+    def add_missing_columns(self):
+        """Adds columns defined in models but missing from existing tables.
+
+        Only nullable columns can be added this way, which covers columns
+        appended to a model over time. Returns the list of added columns
+        as ``table.column`` names.
+        """
+        engine = self.engine
+        preparer = engine.dialect.identifier_preparer
+        inspector = sqlalchemy.inspect(engine)
+        tables = set(inspector.get_table_names())
+        added = []
+        with engine.begin() as conn:
+            for table in self.metadata.sorted_tables:
+                if table.name not in tables:
+                    continue
+                present = set(c['name'] for c in
+                              inspector.get_columns(table.name))
+                for column in table.columns:
+                    if column.name in present:
+                        continue
+                    if not column.nullable:
+                        raise ValueError(
+                            "Can't add not nullable column '%s.%s'" %
+                            (table.name, column.name)
+                        )
+                    conn.execute(sqlalchemy.text(
+                        'ALTER TABLE %s ADD COLUMN %s %s' % (
+                            preparer.format_table(table),
+                            preparer.format_column(column),
+                            column.type.compile(dialect=engine.dialect))
+                    ))
+                    added.append('%s.%s' % (table.name, column.name))
+        return added
+
+    def migrate(self):
+        """Brings existing tables in line with the models.
+
+        Adds missing columns (see :meth:`add_missing_columns`) and
+        indexes, widens integer columns declared as big integers, and drops
+        unique constraints no longer declared in the models. SQLite can't
+        drop constraints, so those tables are rebuilt copying every row.
+        SQLite integers are always 64 bit and are never widened. Returns
+        the list of changes applied.
+        """
+        changes = self.add_missing_columns()
+        engine = self.engine
+        inspector = sqlalchemy.inspect(engine)
+        tables = set(inspector.get_table_names())
+        for table in self.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            stale = _stale_uniques(inspector, table)
+            if stale and engine.dialect.name == 'sqlite':
+                self._rebuild_table(table)
+                changes.append('rebuilt %s' % table.name)
+                continue
+            with engine.begin() as conn:
+                for kind, name, columns in stale:
+                    conn.execute(_drop_unique(table, kind, name, columns))
+                    changes.append('dropped %s' % name)
+                if engine.dialect.name != 'sqlite':
+                    for column in _narrow_columns(inspector, table):
+                        conn.execute(sqlalchemy.text(
+                            _widen_column(column, engine.dialect)))
+                        changes.append('widened %s.%s' %
+                                       (table.name, column.name))
+            present = set(ix['name'] for ix in
+                          inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in present:
+                    index.create(bind=engine)
+                    changes.append('created %s' % index.name)
+        return changes
+
+    def _rebuild_table(self, table):
+        tmp_name = table.name + '__migrate'
+        copy = getattr(table, 'to_metadata', None) or table.tometadata
+        tmp = copy(MetaData(), name=tmp_name)
+        tmp.indexes.clear()
+        columns = ', '.join(self.engine.dialect.identifier_preparer
+                            .format_column(c) for c in table.columns)
+        with self.engine.begin() as conn:
+            # left behind by a rebuild interrupted before its commit
+            tmp.drop(bind=conn, checkfirst=True)
+            tmp.create(bind=conn)
+            conn.execute(sqlalchemy.text(
+                'INSERT INTO %s (%s) SELECT %s FROM %s' %
+                (tmp_name, columns, columns, table.name)
+            ))
+            conn.execute(sqlalchemy.text('DROP TABLE %s' % table.name))
+            conn.execute(sqlalchemy.text(
+                'ALTER TABLE %s RENAME TO %s' % (tmp_name, table.name)
+            ))
+        for index in table.indexes:
+            index.create(bind=self.engine)
+
     def drop_all(self):
         """Drops all tables."""
         self.Model.metadata.drop_all(bind=self.engine)
@@ -247,7 +487,7 @@ class SQLAlchemy(object):
         """Reflection tables from the database.
         """
         meta = meta or MetaData()
-        meta.reflect(bind=self.bind)
+        meta.reflect(bind=self.engine)
         return meta
 
     def __repr__(self):
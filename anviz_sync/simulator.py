@@ -0,0 +1,410 @@
+"""
+    anviz_sync.simulator
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Simulated Anviz terminals speaking the device protocol, to exercise
+    :class:`~anviz_sync.anviz.Device`, ``anviz-sync`` and ``anviz-rt``
+    without real hardware.
+
+    Every :class:`Terminal` holds a synthetic :class:`Dataset` and answers
+    the info, datetime, net params, record info, download and clear
+    commands. Latency, split writes and corrupt bytes can be injected, and a
+    terminal can also push realtime events to ``anviz-rt``. A single
+    :class:`Simulator` runs hundreds of terminals on one event loop::
+
+        python -m anviz_sync.simulator --terminals 100 --records 10000
+
+    :copyright: (c) 2014 by Augusto Roccasalva.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import argparse
+import asyncio
+import random
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+
+from anviz_sync.anviz import (
+    STX, ACK_sum, RET_SUCCESS, RET_FAIL, SSEC, RECORD_SIZE, STAFF_SIZE,
+    CMD_GET_INFO, CMD_GET_DATETIME, CMD_SET_DATETIME, CMD_GET_TCPIP_PARAMS,
+    CMD_GET_RECORD_INFO, CMD_DOWNLOAD_RECORDS, CMD_DOWNLOAD_STAFF_INFO,
+    CMD_CLEAR_RECORDS, crc16, crc16_value, _record, _staff
+)
+
+_request = struct.Struct(">BLBH")
+
+FIRMWARE = b'A300sim\x00'
+
+
+def pack_record(code, dt, bkp=0, rtype=0, work=0):
+    """Inverse of :func:`~anviz_sync.anviz.parse_record`."""
+    sec = int(time.mktime(dt.timetuple()) - SSEC)
+    return _record.pack(code >> 32, code & 0xffffffff, sec, bkp, rtype,
+                        work >> 16, work & 0xffff)
+
+
+def pack_staff(code, name, pwd=None, card=None, dep=0, group=1, mode=0,
+               fp=0, special=0):
+    """Inverse of :func:`~anviz_sync.anviz.parse_s_info`."""
+    def three(value):
+        if value is None:
+            return b'\xff\xff\xff'
+        return value.to_bytes(3, 'big')
+    return _staff.pack(code >> 32, code & 0xffffffff, three(pwd), three(card),
+                       name, dep, group, mode, struct.pack("H", fp), special)
+
+
+def build_response(device_id, cmd, payload=b'', ret=RET_SUCCESS):
+    """Builds the device response frame to `cmd`."""
+    frame = bytearray([STX])
+    frame.extend(struct.pack(">LBBH", device_id, (cmd + ACK_sum) & 0xff, ret,
+                             len(payload)))
+    frame.extend(payload)
+    frame.extend(crc16(frame))
+    return bytes(frame)
+
+
+class Dataset(object):
+    """Synthetic device contents: `records` attendance records of `users`
+    users, one every `interval` seconds starting at `start`. The last `new`
+    records are marked as new.
+    """
+
+    def __init__(self, records=1000, users=50, new=0, start=None,
+                 interval=60, seed=None):
+        rng = random.Random(seed)
+        if start is None:
+            start = datetime.now() - timedelta(seconds=records * interval)
+        self.records = bytearray()
+        for i in range(records):
+            dt = start + timedelta(seconds=i * interval)
+            self.records += pack_record(rng.randrange(1, users + 1), dt,
+                                        rng.randrange(4), rng.randrange(2))
+        self.staff = bytearray()
+        for code in range(1, users + 1):
+            self.staff += pack_staff(code, ('User %d' % code).encode())
+        self.new = min(new, records)
+        self.users = users
+        self.clock_offset = timedelta()
+        self.net_params = bytes([192, 168, 1, 20, 255, 255, 255, 0,
+                                 0, 0x0a, 0x0b, 0x0c, 0x0d, 0x0e,
+                                 192, 168, 1, 1, 192, 168, 1, 10,
+                                 0, 0, 0, 0, 0])
+
+    @property
+    def record_count(self):
+        return len(self.records) // RECORD_SIZE
+
+    def add_record(self, code, dt=None, bkp=0, rtype=0, work=0):
+        """Appends a new record, returns its raw bytes."""
+        raw = pack_record(code, dt or self.now(), bkp, rtype, work)
+        self.records += raw
+        self.new += 1
+        return raw
+
+    def now(self):
+        return datetime.now() + self.clock_offset
+
+    def record_info(self):
+        values = (self.users, 0, 0, 0, self.record_count, self.new)
+        return b''.join(v.to_bytes(3, 'big') for v in values)
+
+
+class Terminal(object):
+    """Simulated terminal `device_id` serving `dataset`.
+
+    Responses are delayed `latency` seconds, plus up to `jitter`, written
+    in chunks of `split` bytes and have one bit flipped with probability
+    `corrupt`.
+    """
+
+    def __init__(self, device_id, dataset, latency=0, jitter=0, split=None,
+                 corrupt=0, split_delay=0.001, seed=None):
+        self.device_id = device_id
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.split = split
+        self.split_delay = split_delay
+        self.corrupt = corrupt
+        self._rng = random.Random(seed)
+        self.port = None
+        self._server = None
+        self._clients = {}
+        #: requests answered, bad requests ignored and bytes sent
+        self.requests = 0
+        self.bad_requests = 0
+        self.bytes_sent = 0
+
+    def handle(self, cmd, data, cursor):
+        """Returns ``(ret, payload)`` answering `cmd` with args `data`.
+
+        `cursor` is a dict holding the download position of the connection.
+        """
+        ds = self.dataset
+        if cmd == CMD_GET_INFO:
+            return RET_SUCCESS, FIRMWARE + bytes(10)
+        if cmd == CMD_GET_DATETIME:
+            now = ds.now()
+            return RET_SUCCESS, bytes([now.year - 2000, now.month, now.day,
+                                       now.hour, now.minute, now.second])
+        if cmd == CMD_SET_DATETIME:
+            y, m, d, h, mi, s = data[:6]
+            ds.clock_offset = datetime(2000 + y, m, d, h, mi, s) - \
+                datetime.now()
+            return RET_SUCCESS, b''
+        if cmd == CMD_GET_TCPIP_PARAMS:
+            return RET_SUCCESS, ds.net_params
+        if cmd == CMD_GET_RECORD_INFO:
+            return RET_SUCCESS, ds.record_info()
+        if cmd == CMD_DOWNLOAD_RECORDS:
+            param, count = data[0], data[1]
+            if param == 1:
+                cursor['records'] = 0
+            elif param == 2:
+                cursor['records'] = ds.record_count - ds.new
+            return RET_SUCCESS, self._page(ds.records, RECORD_SIZE, count,
+                                           cursor, 'records')
+        if cmd == CMD_DOWNLOAD_STAFF_INFO:
+            if data[0] == 1:
+                cursor['staff'] = 0
+            return RET_SUCCESS, self._page(ds.staff, STAFF_SIZE, data[1],
+                                           cursor, 'staff')
+        if cmd == CMD_CLEAR_RECORDS:
+            kind = data[0]
+            if kind == 0:
+                cleared = ds.record_count
+                del ds.records[:]
+                ds.new = 0
+            elif kind == 1:
+                cleared, ds.new = ds.new, 0
+            else:
+                cleared = min(ds.new, int.from_bytes(data[1:4], 'big'))
+                ds.new -= cleared
+            return RET_SUCCESS, cleared.to_bytes(3, 'big')
+        return RET_FAIL, b''
+
+    @staticmethod
+    def _page(items, size, count, cursor, key):
+        start = cursor.get(key, 0)
+        page = items[start * size:(start + count) * size]
+        cursor[key] = start + len(page) // size
+        return bytes([len(page) // size]) + bytes(page)
+
+    async def _write(self, writer, frame):
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self._rng.random() *
+                                self.jitter)
+        if self.corrupt and self._rng.random() < self.corrupt:
+            frame = bytearray(frame)
+            frame[self._rng.randrange(len(frame))] ^= \
+                1 << self._rng.randrange(8)
+        if self.split:
+            for pos in range(0, len(frame), self.split):
+                writer.write(frame[pos:pos + self.split])
+                await writer.drain()
+                await asyncio.sleep(self.split_delay)
+        else:
+            writer.write(frame)
+            await writer.drain()
+        self.bytes_sent += len(frame)
+
+    async def _serve_client(self, reader, writer):
+        cursor = {}
+        self._clients[writer] = asyncio.current_task()
+        try:
+            while True:
+                header = await reader.readexactly(_request.size)
+                stx, device_id, cmd, length = _request.unpack(header)
+                rest = await reader.readexactly(length + 2)
+                if stx != STX or crc16_value(header + rest[:-2]) != \
+                        rest[-2] | rest[-1] << 8:
+                    self.bad_requests += 1
+                    continue
+                ret, payload = self.handle(cmd, rest[:-2], cursor)
+                self.requests += 1
+                await self._write(writer, build_response(
+                    self.device_id, cmd, payload, ret))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Starts listening, returns the bound port."""
+        self._server = await asyncio.start_server(self._serve_client, host,
+                                                  port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        # closing client connections ends their handlers
+        clients = list(self._clients.items())
+        for writer, _ in clients:
+            writer.close()
+        await asyncio.gather(*[task for _, task in clients],
+                             return_exceptions=True)
+
+    async def push(self, host, port, events, rate=None):
+        """Connects to ``anviz-rt`` at `host`:`port` and pushes `events`
+        new records, at most `rate` per second. Returns the number pushed.
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for _ in range(events):
+                raw = self.dataset.add_record(
+                    self._rng.randrange(1, self.dataset.users + 1),
+                    rtype=self._rng.randrange(2))
+                await self._write(writer, build_response(
+                    self.device_id, CMD_DOWNLOAD_RECORDS, raw))
+                if rate:
+                    await asyncio.sleep(1.0 / rate)
+        finally:
+            writer.close()
+        return events
+
+
+class Simulator(object):
+    """Runs `count` terminals with ids from `first_id`, each one with its
+    own dataset built from `dataset_options` and listening on its own port,
+    consecutive from `port` or ephemeral if it is 0. `terminal_options` are
+    passed to every :class:`Terminal`.
+    """
+
+    def __init__(self, count=1, first_id=1, host='127.0.0.1', port=0,
+                 dataset_options={}, terminal_options={}):
+        self.host = host
+        self.port = port
+        self.terminals = [
+            Terminal(first_id + i, Dataset(seed=first_id + i,
+                                           **dataset_options),
+                     **terminal_options)
+            for i in range(count)
+        ]
+        self._loop = None
+        self._thread = None
+
+    async def start(self):
+        for i, terminal in enumerate(self.terminals):
+            await terminal.start(self.host, self.port + i if self.port else 0)
+        return self
+
+    async def stop(self):
+        for terminal in self.terminals:
+            await terminal.stop()
+
+    async def push(self, host, port, events, rate=None):
+        """Pushes `events` from every terminal concurrently, see
+        :meth:`Terminal.push`. Returns the total pushed.
+        """
+        counts = await asyncio.gather(*[
+            t.push(host, port, events, rate) for t in self.terminals
+        ])
+        return sum(counts)
+
+    def start_background(self):
+        """Runs the terminals on an event loop in a daemon thread, for use
+        from blocking code. Returns once every terminal listens.
+        """
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop_background(self):
+        future = asyncio.run_coroutine_threadsafe(self.stop(), self._loop)
+        future.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def config(self, prefix='sim'):
+        """Returns ``anviz-sync.ini`` device sections for the terminals."""
+        return ''.join(
+            '[anviz:%s%d]\ndevice_id = %d\nip_addr = %s\nip_port = %d\n\n' %
+            (prefix, t.device_id, t.device_id, self.host, t.port)
+            for t in self.terminals
+        )
+
+    def stats(self):
+        """Returns ``(requests, bad_requests, bytes_sent)`` totals."""
+        return (sum(t.requests for t in self.terminals),
+                sum(t.bad_requests for t in self.terminals),
+                sum(t.bytes_sent for t in self.terminals))
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m anviz_sync.simulator',
+                                     description="Simulated Anviz terminals")
+    parser.add_argument('--terminals', type=int, default=1)
+    parser.add_argument('--first-id', type=int, default=1)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5010,
+                        help='port of the first terminal, 0 for ephemeral')
+    parser.add_argument('--records', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--new', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds before every response')
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--split', type=int, default=None,
+                        help='write responses in chunks of this size')
+    parser.add_argument('--corrupt', type=float, default=0,
+                        help='probability of corrupting a response')
+    parser.add_argument('--push', metavar='HOST:PORT',
+                        help='push realtime events to anviz-rt instead')
+    parser.add_argument('--events', type=int, default=100,
+                        help='events pushed by every terminal')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='events per second per terminal')
+    return parser.parse_args(argv)
+
+
+async def _main(args):
+    sim = Simulator(
+        args.terminals, args.first_id, args.host, args.port,
+        dataset_options=dict(records=args.records, users=args.users,
+                             new=args.new),
+        terminal_options=dict(latency=args.latency, jitter=args.jitter,
+                              split=args.split, corrupt=args.corrupt),
+    )
+    if args.push:
+        host, port = args.push.rsplit(':', 1)
+        start = time.time()
+        pushed = await sim.push(host, int(port), args.events, args.rate)
+        elapsed = time.time() - start
+        print("pushed %d events in %.2fs (%.0f events/s)" %
+              (pushed, elapsed, pushed / elapsed if elapsed else 0))
+        return
+    await sim.start()
+    print(sim.config(), end='', flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        requests, bad, sent = sim.stats()
+        print("%d requests, %d bad, %d bytes sent" % (requests, bad, sent))
+
+
+def main(argv=None):
+    try:
+        asyncio.run(_main(_parse_args(argv)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+    anviz_sync.spool
+    ~~~~~~~~~~~~~~~~
+
+    Append-only local spool of realtime events, written before events reach
+    the database so a slow or unreachable database never loses punches.
+
+    The spool is a directory of segment files named after the sequence
+    number of their first entry, plus a checkpoint file holding the last
+    sequence number committed to the database. The database writer tails
+    the spool from the checkpoint, only reading entries already synced to
+    disk, and segments fully behind the checkpoint are deleted.
+
+    :copyright: (c) 2022 by Augusto Roccasalva
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import struct
+import threading
+import zlib
+from collections import namedtuple
+
+#: seq, received (unix time), device id, raw record, crc32 of the former
+_entry = struct.Struct("<QdL14sL")
+ENTRY_SIZE = _entry.size
+
+SpoolEntry = namedtuple("SpoolEntry", "seq received device_id data")
+
+_prefix = 'spool-'
+_suffix = '.log'
+
+
+def _segment_name(seq):
+    return '%s%016d%s' % (_prefix, seq, _suffix)
+
+
+class Spool(object):
+    """Segmented append-only event log stored in `path`.
+
+    :meth:`append` only buffers, call :meth:`sync` to make appended entries
+    durable (see :attr:`dirty`). A single consumer thread reads durable
+    entries with :meth:`read` and records the last sequence number
+    committed downstream with :meth:`ack`, which drops segments no longer
+    needed.
+    """
+
+    def __init__(self, path, segment_entries=65536):
+        self.path = path
+        self.segment_entries = segment_entries
+        self._lock = threading.Lock()
+        self._file = None
+        self._segment_count = 0
+        #: entries appended and not synced yet
+        self.dirty = 0
+        os.makedirs(path, exist_ok=True)
+        self.committed = self._read_checkpoint()
+        self.next_seq = self._recover()
+        #: last sequence number synced to disk
+        self.synced = self.next_seq - 1
+
+    def _checkpoint_path(self):
+        return os.path.join(self.path, 'checkpoint')
+
+    def _read_checkpoint(self):
+        try:
+            with open(self._checkpoint_path(), 'rb') as f:
+                return struct.unpack("<Q", f.read(8))[0]
+        except (OSError, struct.error):
+            return 0
+
+    def _write_checkpoint(self, seq):
+        tmp = self._checkpoint_path() + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(struct.pack("<Q", seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._checkpoint_path())
+
+    def segments(self):
+        """Returns ``(first_seq, path)`` for every segment, oldest first."""
+        result = []
+        for name in os.listdir(self.path):
+            if name.startswith(_prefix) and name.endswith(_suffix):
+                seq = int(name[len(_prefix):-len(_suffix)])
+                result.append((seq, os.path.join(self.path, name)))
+        return sorted(result)
+
+    def _recover(self):
+        # check every entry, truncating a torn tail
+        next_seq = self.committed + 1
+        for first, path in self.segments():
+            with open(path, 'r+b') as f:
+                data = f.read()
+                valid = 0
+                for offset in range(0, len(data) - ENTRY_SIZE + 1,
+                                    ENTRY_SIZE):
+                    entry = _entry.unpack_from(data, offset)
+                    raw = data[offset:offset + ENTRY_SIZE - 4]
+                    if zlib.crc32(raw) != entry[-1]:
+                        break
+                    valid = offset + ENTRY_SIZE
+                    next_seq = max(next_seq, entry[0] + 1)
+                if valid != len(data):
+                    f.truncate(valid)
+        return next_seq
+
+    @property
+    def pending(self):
+        """Number of entries not committed downstream yet."""
+        return self.next_seq - 1 - self.committed
+
+    def read(self, after, limit):
+        """Returns up to `limit` entries synced to disk following sequence
+        number `after`, oldest first.
+        """
+        last = min(self.synced, after + limit)
+        if last <= after:
+            return []
+        entries = []
+        segments = self.segments()
+        for i, (first, path) in enumerate(segments):
+            if first > last:
+                break
+            if i + 1 < len(segments) and segments[i + 1][0] <= after + 1:
+                continue
+            # sequence numbers are consecutive within a segment
+            skip = max(0, after + 1 - first)
+            with open(path, 'rb') as f:
+                f.seek(skip * ENTRY_SIZE)
+                data = f.read((last - first - skip + 1) * ENTRY_SIZE)
+            for offset in range(0, len(data) - ENTRY_SIZE + 1, ENTRY_SIZE):
+                seq, received, device_id, record, crc = \
+                    _entry.unpack_from(data, offset)
+                if zlib.crc32(data[offset:offset + ENTRY_SIZE - 4]) != crc:
+                    raise ValueError("Corrupt spool entry in %s" % path)
+                if after < seq <= last:
+                    entries.append(
+                        SpoolEntry(seq, received, device_id, record)
+                    )
+        return entries
+
+    def append(self, device_id, data, received):
+        """Appends a raw record, returns its sequence number."""
+        with self._lock:
+            if self._file is None or \
+                    self._segment_count >= self.segment_entries:
+                self._rotate()
+            seq = self.next_seq
+            raw = _entry.pack(seq, received, device_id, data, 0)[:-4]
+            self._file.write(raw + struct.pack("<L", zlib.crc32(raw)))
+            self._segment_count += 1
+            self.next_seq += 1
+            self.dirty += 1
+            return seq
+
+    def _rotate(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+        path = os.path.join(self.path, _segment_name(self.next_seq))
+        self._file = open(path, 'ab')
+        self._segment_count = 0
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.dirty = 0
+        self.synced = self.next_seq - 1
+
+    def sync(self):
+        """Makes every appended entry durable.
+
+        The fsync itself runs outside the lock, so it can be called from a
+        worker thread without blocking :meth:`append`.
+        """
+        with self._lock:
+            if self._file is None or not self.dirty:
+                return
+            self._file.flush()
+            fd = os.dup(self._file.fileno())
+            last = self.next_seq - 1
+            self.dirty = 0
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        with self._lock:
+            self.synced = max(self.synced, last)
+
+    def ack(self, seq):
+        """Marks every entry up to `seq` as committed and deletes segments
+        holding only committed entries.
+
+        The checkpoint is written and segments deleted outside the lock, so
+        :meth:`append` is never held back by this file I/O.
+        """
+        if seq <= self.committed:
+            return
+        self._write_checkpoint(seq)
+        with self._lock:
+            self.committed = seq
+            current = self._file.name if self._file is not None else None
+        segments = self.segments()
+        for (first, path), (next_first, _) in zip(segments, segments[1:]):
+            if next_first - 1 <= seq and path != current:
+                os.remove(path)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
@@ -7,88 +7,358 @@
     :copyright: (c) 2014 by Augusto Roccasalva.
     :license: BSD, see LICENSE for more details.
 """
+import hashlib
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from datetime import datetime
 
-from anviz_sync.saw import SQLAlchemy
-from anviz_sync.anviz import Device
-from anviz_sync.progress import ProgressBar, ProgressDummy
+from sqlalchemy.exc import SQLAlchemyError
 
-db = SQLAlchemy()
+from anviz_sync import metrics
+from anviz_sync.capture import CaptureReader, CaptureWriter
+from anviz_sync.config import device_addresses, load_devices, replay_path
+from anviz_sync.models import (
+    db, SyncState, configure_db, existing_keys, insert_rows,
+    replace_staff_pages
+)
+from anviz_sync.anviz import (
+    SSEC, DeviceException, RecordBatch, parse_staff_info, pool
+)
+from anviz_sync.progress import ProgressDummy, progress_bar
 
-class AttendanceRecord(db.Model):
-    __tablename__ = 'attendance_record'
+def _rebatch(batches, size):
+    pending, count = [], 0
+    for batch in batches:
+        pending.append(batch)
+        count += len(batch)
+        if count >= size:
+            yield RecordBatch.concat(pending)
+            pending, count = [], 0
+    if pending:
+        yield RecordBatch.concat(pending)
 
-    id = db.Column(db.Integer, primary_key=True)
-    user_code = db.Column(db.Integer, nullable=False)
-    datetime = db.Column(db.DateTime, nullable=False, unique=True)
-    bkp_type = db.Column(db.Integer, nullable=False)
-    type_code = db.Column(db.Integer, nullable=False)
 
+def store_records(batches, device=None, chunk_size=500, since=None,
+                  pbar=None, on_chunk=None):
+    """Stores records from `batches` skipping those already present in db.
 
-def sync(progress=False, force_all=False):
+    Each :class:`~anviz_sync.anviz.RecordBatch` is buffered in chunks of at
+    least `chunk_size` records, checked against the database with one query
+    per chunk and written with a bulk insert. Records older than `since` are
+    skipped without querying. Rows are tagged with `device`. If given,
+    ``on_chunk(count)`` is called after every chunk is written with the
+    number of records it consumed. Returns ``(inserted, skipped)``.
+    """
+    inserted = skipped = 0
+    for batch in _rebatch(batches, chunk_size):
+        with metrics.phase('dedup', len(batch)):
+            candidates = [
+                (code, dt, bkp, rtype, None, device)
+                for code, dt, bkp, rtype in zip(
+                    batch.column('code'), batch.datetimes(),
+                    batch.column('bkp'), batch.column('type'))
+                if since is None or dt >= since
+            ]
+            skipped += len(batch) - len(candidates)
+            if candidates:
+                seen = existing_keys(set(c[0] for c in candidates),
+                                     min(c[1] for c in candidates),
+                                     max(c[1] for c in candidates), device)
+            rows = []
+            for row in candidates:
+                key = row[:2]
+                if key in seen:
+                    skipped += 1
+                    continue
+                seen.add(key)
+                rows.append(row)
+        with metrics.phase('insert', len(rows)):
+            count = insert_rows(rows)
+        # rows stored concurrently are ignored by the database
+        inserted += count
+        skipped += len(rows) - count
+        if on_chunk is not None:
+            on_chunk(len(batch))
+        if pbar is not None:
+            pbar.step(len(batch))
+    return inserted, skipped
+
+
+def plan_download(state, info, force_all=False):
+    """Chooses how to download records given the stored sync `state` and
+    the device record `info`.
+
+    Returns ``(only_new, since, skip)``. An interrupted full download is
+    resumed skipping the `skip` records already stored. New records are
+    only trusted when the device new record count matches the records past
+    the stored cursor, otherwise everything is downloaded and records older
+    than `since` are discarded before reaching the database.
+    """
+    offset = state.resume_offset or 0
+    if offset:
+        if info.all_records >= offset:
+            return False, None, offset
+        # device records were erased, the checkpoint is meaningless
+        state.resume_offset = 0
+    if force_all or state.last_datetime is None:
+        return False, None, 0
+    if info.all_records < state.record_count:
+        # device records were erased, start over
+        return False, None, 0
+    if info.new_records == info.all_records - state.record_count:
+        return True, None, 0
+    return False, state.last_datetime, 0
+
+
+def _track_cursor(batches, state):
+    for batch in batches:
+        if len(batch):
+            dt = datetime.fromtimestamp(SSEC + max(batch.column('sec')))
+            if state.last_datetime is None or dt > state.last_datetime:
+                state.last_datetime = dt
+        yield batch
+
+
+def sync_staff(clock, state, users, force=False):
+    """Refreshes the stored staff of device `clock`, `state` is its
+    :class:`SyncState` and `users` its current user count.
+
+    Nothing is downloaded when the user count didn't change since the last
+    refresh, unless `force` is set. Downloaded pages matching the hash
+    stored for them are neither parsed nor written. Returns the number of
+    pages written.
+    """
+    if not force and state.staff_hashes is not None and \
+            state.staff_count == users:
+        return 0
+    old = (state.staff_hashes or '').split()
+    hashes, changed = [], {}
+    # download everything before writing, keeping the transaction short
+    for page, data in enumerate(list(clock.staff_pages(users))):
+        digest = hashlib.sha1(data).hexdigest()
+        if page >= len(old) or old[page] != digest:
+            changed[page] = parse_staff_info(data)
+        hashes.append(digest)
+    replace_staff_pages(state.device, changed, len(hashes))
+    state.staff_count = users
+    state.staff_hashes = ' '.join(hashes)
+    state.staff_updated = datetime.now()
+    return len(changed)
+
+
+def sync_device(dev, force_all=False, progress=False, force_staff=False,
+                capture=None):
+    """Syncs records and staff from device `dev` (a :class:`DeviceConfig`)
+    into db. Device responses are appended to `capture`, a
+    :class:`CaptureWriter`, if given.
+
+    Returns ``(inserted, skipped)``.
+    """
+    options = dict(timeout=dev.timeout, records_page=dev.records_page,
+                   staff_page=dev.staff_page, pipeline=dev.pipeline,
+                   connect_timeout=dev.connect_timeout,
+                   keepalive=dev.keepalive or None)
+    with pool.device(dev.device_id, dev.ip_addr, dev.ip_port,
+                     **options) as clock:
+        # pooled devices may have been created by another sync
+        clock.capture = capture
+        clock.name = dev.name
+        with metrics.phase('connect'):
+            clock.connect()
+        # Check sync cursor
+        state = SyncState.query.get(dev.name)
+        if state is None:
+            state = SyncState(device=dev.name, record_count=0)
+            db.add(state)
+        with metrics.phase('record_info'):
+            info = clock.get_record_info()
+        only_new, since, skip = plan_download(state, info, force_all)
+
+        if progress:
+            total = info.new_records if only_new else info.all_records
+            pbar = progress_bar("sync [{}]".format(dev.name), total - skip)
+        else:
+            pbar = ProgressDummy()
+
+        act_name = ('new' if only_new else 'all') + ' records'
+        act_col = 'green' if only_new else 'red'
+
+        pbar.set_activity(act_name, act_col)
+        pbar.step(0)
+
+        # commit every chunk so no write lock is held while downloading,
+        # full downloads also checkpoint so an interrupted one resumes
+        # where it stopped
+        if not only_new:
+            state.resume_offset = skip
+
+        def on_chunk(count):
+            if not only_new:
+                state.resume_offset += count
+            with metrics.phase('commit'):
+                db.commit()
+
+        batches = metrics.timed(
+            clock.download_record_batches(only_new, clear=False, skip=skip),
+            'download'
+        )
+        inserted, skipped = store_records(_track_cursor(batches, state),
+                                          device=dev.name, since=since,
+                                          pbar=pbar, on_chunk=on_chunk)
+        state.record_count = info.all_records
+        state.resume_offset = 0
+        state.updated = datetime.now()
+
+        with metrics.phase('commit'):
+            db.commit()
+
+        # new record marks are only cleared once records are safely stored
+        if info.new_records > 0:
+            clock.clear_records(info.new_records)
+
+        with metrics.phase('staff'):
+            sync_staff(clock, state, info.users, force_staff)
+            db.commit()
+
+    pbar.finish('synced {} new, {} skipped'.format(inserted, skipped))
+    return inserted, skipped
+
+
+SyncResult = namedtuple("SyncResult", "name inserted skipped error elapsed")
+
+
+def _run_job(dev, force_all, progress, force_staff=False, capture=None):
+    start = time.time()
+    attempt = 0
+    try:
+        while True:
+            try:
+                inserted, skipped = sync_device(dev, force_all, progress,
+                                                force_staff, capture)
+                return SyncResult(dev.name, inserted, skipped, None,
+                                  time.time() - start)
+            except (DeviceException, OSError, SQLAlchemyError) as err:
+                db.rollback()
+                attempt += 1
+                if attempt > dev.retries:
+                    return SyncResult(dev.name, 0, 0, err,
+                                      time.time() - start)
+                time.sleep(min(2 ** attempt, 30))
+                # retry in lock-step in case the device can't pipeline
+                dev = dev._replace(pipeline=1)
+            except Exception as err:
+                # a bug hit by one device must not abort the others
+                db.rollback()
+                return SyncResult(dev.name, 0, 0, err, time.time() - start)
+    finally:
+        db.session.remove()
+
+
+def print_summary(results, stream=sys.stdout):
+    stream.write("%-20s %-8s %9s %9s %8s\n" %
+                 ("device", "status", "inserted", "skipped", "time"))
+    for r in results:
+        status = 'ok' if r.error is None else 'error'
+        stream.write("%-20s %-8s %9d %9d %7.1fs\n" %
+                     (r.name[:20], status, r.inserted, r.skipped, r.elapsed))
+        if r.error is not None:
+            stream.write("    %s\n" % r.error)
+    stream.flush()
+
+
+def sync(progress=False, force_all=False, force_staff=False):
     config = ConfigParser()
     config.read('anviz-sync.ini')
 
-    # config device
-    dev_id = config.getint('anviz', 'device_id')
-    ip_addr = config.get('anviz', 'ip_addr')
-    ip_port = config.getint('anviz', 'ip_port')
-    clock = Device(dev_id, ip_addr, ip_port)
+    # config devices
+    devices = load_devices(config)
+    workers = config.getint('sync', 'workers', fallback=8)
 
     # config db
-    db_uri = config.get('sqlalchemy', 'uri')
-    db.configure(db_uri)
-    db.create_all()
-
-    # Check stored db
-    count = AttendanceRecord.query.count()
-    if count == 0 or force_all:
-        only_new = False
-    else:
-        only_new = True
+    configure_db(config.get('sqlalchemy', 'uri'))
+    stats = metrics.from_config(config)
 
-    if progress:
-        total = getattr(clock.get_record_info(),
-                        'new_records' if only_new else 'all_records')
-        pbar = ProgressBar("sync [{}]".format(ip_addr), total)
-    else:
-        pbar = ProgressDummy()
+    # progress bars would overlap with more than one device
+    progress = progress and len(devices) == 1
 
-    act_name = ('new' if only_new else 'all') + ' records'
-    act_col = 'green' if only_new else 'red'
+    capture = None
+    if config.has_option('sync', 'capture'):
+        capture = CaptureWriter(config.get('sync', 'capture'))
 
-    pbar.set_activity(act_name, act_col)
-    pbar.step(0)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(executor.map(
+                lambda dev: _run_job(dev, force_all, progress, force_staff,
+                                     capture),
+                devices
+            ))
+    finally:
+        if capture is not None:
+            capture.close()
 
-    for record in clock.download_records(only_new):
-        user_record = AttendanceRecord(
-                user_code=record.code,
-                datetime=record.datetime,
-                bkp_type=record.bkp,
-                type_code=record.type
-        )
+    # a single device shows its progress bar, errors are always reported
+    if len(devices) > 1 or any(r.error is not None for r in results):
+        print_summary(results)
+    if stats is not None:
+        stats.flush()
+    return results
 
-        # check that record don't exist in db
-        count = AttendanceRecord.query.filter(AttendanceRecord.user_code==record.code)\
-                                .filter(AttendanceRecord.datetime==record.datetime)\
-                                .count()
-        if count == 0:
-            # store
-            db.add(user_record)
-        else:
-            # discard
-            pass
-        pbar.step()
 
-    db.commit()
-    pbar.finish('synced')
+def replay(path):
+    """Stores the records found in the capture log at `path`, skipping
+    those already present in db. Records are tagged with the device name
+    they were captured under, unnamed ``ip:port`` sources are named as the
+    configured device at that address. Sync cursors are left untouched.
+    """
+    config = ConfigParser()
+    config.read('anviz-sync.ini')
+    names = device_addresses(config)
+    configure_db(config.get('sqlalchemy', 'uri'))
 
+    results = []
+    with CaptureReader(path) as reader:
+        for source in reader.sources():
+            name = names.get(source, source)
+            start = time.time()
+            try:
+                inserted, skipped = store_records(
+                    reader.record_batches(source), device=name,
+                    on_chunk=lambda count: db.commit()
+                )
+                db.commit()
+                error = None
+            except (DeviceException, SQLAlchemyError) as err:
+                db.rollback()
+                inserted = skipped = 0
+                error = err
+            results.append(SyncResult(name, inserted, skipped, error,
+                                      time.time() - start))
+    print_summary(results)
+    return results
 
-def main():
-    import sys
-    progress = '--no-progress' not in sys.argv
-    force_all = '--all' in sys.argv
-    sync(progress=progress, force_all=force_all)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    progress = '--no-progress' not in argv
+    force_all = '--all' in argv
+    force_staff = '--staff' in argv
+    if '--replay' in argv:
+        path = replay_path(argv)
+        if path is None:
+            sys.stderr.write("usage: anviz-sync --replay <capture>\n")
+            sys.exit(2)
+        results = replay(path)
+    else:
+        try:
+            results = sync(progress=progress, force_all=force_all,
+                           force_staff=force_staff)
+        finally:
+            pool.close_all()
+    if any(r.error is not None for r in results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,189 @@
+"""
+    anviz_sync.writer
+    ~~~~~~~~~~~~~~~~~
+
+    Background writer storing realtime events with group commits.
+
+    :copyright: (c) 2022 by Augusto Roccasalva
+    :license: BSD, see LICENSE for more details.
+"""
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy.exc import (
+    DisconnectionError, OperationalError, SQLAlchemyError
+)
+
+from anviz_sync import metrics
+from anviz_sync.anviz import parse_record
+from anviz_sync.models import db, store_events
+
+_stop = object()
+
+#: errors worth retrying, the database may be back later
+_transient = (OperationalError, DisconnectionError)
+
+
+class RecordWriter(threading.Thread):
+    """Thread that stores queued events in the database.
+
+    Events are committed in groups of `batch_size` or every `interval`
+    seconds, whichever comes first, so database latency never reaches the
+    code reading the sockets. Commits failing with a transient error, like
+    a lost connection or a locked database, are retried with backoff. On
+    any other database error the batch is stored in halves until the
+    failing events are found, those are logged and dropped.
+    """
+
+    def __init__(self, batch_size=100, interval=0.5, maxsize=10000,
+                 on_commit=None):
+        super(RecordWriter, self).__init__(name='anviz-writer', daemon=True)
+        self.batch_size = batch_size
+        self.interval = interval
+        #: called with every committed batch
+        self.on_commit = on_commit
+        self._queue = queue.Queue(maxsize)
+        self._stopping = False
+        #: events stored, commits done and events dropped so far
+        self.stored = 0
+        self.commits = 0
+        self.dropped = 0
+
+    def put(self, device, record, received=None, seq=None, block=True):
+        """Queues `record` from `device`, `received` defaults to now.
+
+        `seq` is an opaque value handed back through `on_commit`, like the
+        spool sequence number of the event. Raises :class:`queue.Full` when
+        not blocking and the queue is full.
+        """
+        if received is None:
+            received = datetime.now()
+        self._queue.put((device, record, received, seq), block)
+
+    def stop(self, timeout=None):
+        """Commits pending events and stops the thread."""
+        self._queue.put(_stop)
+        self.join(timeout)
+
+    def _collect(self):
+        item = self._queue.get()
+        if item is _stop:
+            self._stopping = True
+            return []
+        batch = [item]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _stop:
+                self._stopping = True
+                break
+            batch.append(item)
+        return batch
+
+    def _store(self, batch):
+        try:
+            with metrics.phase('store', len(batch)):
+                self.stored += store_events(e[:3] for e in batch)
+                db.commit()
+            self.commits += 1
+        except _transient:
+            raise
+        except SQLAlchemyError as err:
+            # retrying would fail again, isolate the events causing it
+            db.rollback()
+            if len(batch) > 1:
+                half = len(batch) // 2
+                self._store(batch[:half])
+                self._store(batch[half:])
+                return
+            self.dropped += 1
+            metrics.count("writer_dropped_events")
+            device, record = batch[0][:2]
+            print("[{}] Dropping event from {} {}: {}".format(
+                datetime.now(), device, record, err))
+
+    def _commit(self, batch):
+        delay = self.interval
+        while True:
+            try:
+                self._store(batch)
+                break
+            except _transient as err:
+                db.rollback()
+                if self._give_up():
+                    self._stopping = True
+                    return
+                print("[{}] Commit failed, retrying in {:.1f}s: {}".format(
+                    datetime.now(), delay, err))
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+        if self.on_commit is not None:
+            self.on_commit(batch)
+
+    def _give_up(self):
+        # queued events only live in memory, keep retrying
+        return False
+
+    def run(self):
+        try:
+            while not self._stopping:
+                batch = self._collect()
+                if batch:
+                    self._commit(batch)
+        finally:
+            db.session.remove()
+
+
+class SpoolDrain(RecordWriter):
+    """Thread storing the events of a :class:`~anviz_sync.spool.Spool`.
+
+    Entries synced to disk are tailed from the spool checkpoint, stored in
+    groups of up to `batch_size` and acked once committed, so events are
+    never dropped when the database is slow or down, they just wait in the
+    spool. Devices are named from `names` (device id to name) or by their
+    bare id. When idle the spool is polled every `interval` seconds.
+    """
+
+    def __init__(self, spool, names={}, batch_size=100, interval=0.5):
+        super(SpoolDrain, self).__init__(batch_size, interval, maxsize=1)
+        self.name = 'anviz-spool-drain'
+        self.spool = spool
+        self.names = names
+        self.on_commit = lambda batch: spool.ack(batch[-1][3])
+        self._wakeup = threading.Event()
+        self._stop_requested = False
+
+    def put(self, *args, **kwargs):
+        raise TypeError("Events reach a SpoolDrain through its spool")
+
+    def stop(self, timeout=None):
+        """Stores events synced so far and stops the thread, events left
+        once `timeout` expires stay in the spool.
+        """
+        self._stop_requested = True
+        self._wakeup.set()
+        self.join(timeout)
+
+    def _give_up(self):
+        # events stay in the spool, don't hold back a shutdown
+        return self._stop_requested
+
+    def _collect(self):
+        entries = self.spool.read(self.spool.committed, self.batch_size)
+        if not entries:
+            if self._stop_requested:
+                self._stopping = True
+            else:
+                self._wakeup.wait(self.interval)
+            return []
+        return [(self.names.get(e.device_id, str(e.device_id)),
+                 parse_record(e.data), datetime.fromtimestamp(e.received),
+                 e.seq) for e in entries]
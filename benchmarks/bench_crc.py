@@ -0,0 +1,43 @@
+"""
+    CRC-16 microbenchmark
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the crc16 backends against the original pure python loop.
+
+    Usage: python -m benchmarks.bench_crc
+"""
+import os
+import timeit
+
+from anviz_sync import crc
+
+
+_crc_table = crc._crc_table
+
+
+def crc16_original(data):
+    # implementation shipped before anviz_sync.crc existed
+    value = 0xffff
+    for b in data:
+        value = value ^ b
+        value = (value >> 8) ^ _crc_table[value & 0xff]
+    return value
+
+
+def main(number=2000):
+    # realtime frame, full download page response, large buffer
+    for size in (23, 362, 65536):
+        data = os.urandom(size)
+        n = max(1, number * 362 // size)
+        base = timeit.timeit(lambda: crc16_original(data), number=n)
+        print("%6d bytes:" % size)
+        for name, func in (('original', crc16_original),
+                           ('crc16_py', crc.crc16_py),
+                           ('crc16_binascii', crc.crc16_binascii)):
+            elapsed = timeit.timeit(lambda: func(data), number=n)
+            print("    %-16s %9.2f us/call  x%.1f" %
+                  (name, elapsed / n * 1e6, base / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+    Import time benchmark
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Measures the import time of the command line entry points in fresh
+    interpreters, and fails when a protocol only entry point imports
+    SQLAlchemy.
+
+    Usage: python -m benchmarks.bench_import
+"""
+import subprocess
+import sys
+
+#: module and whether it may import SQLAlchemy
+MODULES = (
+    ('anviz_sync.anviz', False),
+    ('anviz_sync.cli', False),
+    ('anviz_sync.rt', False),
+    ('anviz_sync.sync', True),
+)
+
+_probe = """
+import sys, time
+start = time.perf_counter()
+import %s
+print(time.perf_counter() - start, 'sqlalchemy' in sys.modules)
+"""
+
+
+def measure(module, repeat=5):
+    """Returns ``(best seconds, imports sqlalchemy)`` for `module`."""
+    best, loads_sqlalchemy = None, False
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c',
+                                       _probe % module])
+        elapsed, loaded = out.split()
+        elapsed = float(elapsed)
+        loads_sqlalchemy = loaded == b'True'
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, loads_sqlalchemy
+
+
+def main(repeat=5):
+    status = 0
+    for module, allowed in MODULES:
+        elapsed, loaded = measure(module, repeat)
+        flag = ''
+        if loaded and not allowed:
+            flag = '  imports sqlalchemy!'
+            status = 1
+        print("%-20s %8.1f ms%s" % (module, elapsed * 1000, flag))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,343 @@
+"""
+    Benchmark suite
+    ~~~~~~~~~~~~~~~
+
+    Times the protocol hot paths (crc16, build_request, parse_records,
+    RecordBatch, parse_staff_info, realtime frame decoding, capture replay)
+    and the end to end paths through SQLite (storing records, a full sync
+    against a simulated terminal, realtime ingestion) at several sizes.
+
+    Results are written as JSON and, given a baseline written by a previous
+    run, compared against it. The exit status is 1 when any benchmark got
+    slower than the baseline by more than the threshold.
+
+    Usage::
+
+        python -m benchmarks.suite --output baseline.json
+        python -m benchmarks.suite --baseline baseline.json --threshold 0.2
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from anviz_sync import anviz
+from anviz_sync.anviz import (
+    CMD_DOWNLOAD_RECORDS, FrameDecoder, RecordBatch, build_request, crc16,
+    parse_record, parse_records, parse_staff_info
+)
+from anviz_sync.capture import CaptureReader, CaptureWriter
+from anviz_sync.simulator import Dataset, Simulator, build_response
+
+#: registered ``(name, function, end_to_end)``
+BENCHMARKS = []
+
+_datasets = {}
+
+
+def benchmark(name, e2e=False):
+    """Registers ``func(n)`` returning a function that runs the benchmark
+    over `n` records and returns its elapsed seconds.
+    """
+    def register(func):
+        BENCHMARKS.append((name, func, e2e))
+        return func
+    return register
+
+
+def _loop(work, min_time=0.2):
+    # seconds per call of `work`, calling it enough times to be measurable
+    def run():
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                work()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                return elapsed / number
+            number *= 10 if elapsed < min_time / 10 else 2
+    return run
+
+
+def _dataset(n):
+    if n not in _datasets:
+        _datasets[n] = Dataset(records=n, users=min(n, 1000), seed=n)
+    return _datasets[n]
+
+
+def _pages(data, size, per_page):
+    return [bytes([len(data[i:i + size * per_page]) // size]) +
+            bytes(data[i:i + size * per_page])
+            for i in range(0, len(data), size * per_page)]
+
+
+def _record_pages(n):
+    return _pages(_dataset(n).records, anviz.RECORD_SIZE, 25)
+
+
+def _frames(n):
+    records = _dataset(n).records
+    size = anviz.RECORD_SIZE
+    return [build_response(1, CMD_DOWNLOAD_RECORDS, records[i:i + size])
+            for i in range(0, len(records), size)]
+
+
+@benchmark('crc16')
+def bench_crc16(n):
+    frames = [build_response(1, CMD_DOWNLOAD_RECORDS, page)[:-2]
+              for page in _record_pages(n)]
+
+    def work():
+        for frame in frames:
+            crc16(frame)
+    return _loop(work)
+
+
+@benchmark('build_request')
+def bench_build_request(n):
+    pages = range((n + 24) // 25)
+
+    def work():
+        for _ in pages:
+            build_request(1, CMD_DOWNLOAD_RECORDS, [0, 25])
+    return _loop(work)
+
+
+@benchmark('parse_records')
+def bench_parse_records(n):
+    pages = _record_pages(n)
+
+    def work():
+        for page in pages:
+            parse_records(page)
+    return _loop(work)
+
+
+@benchmark('record_batches')
+def bench_record_batches(n):
+    pages = _record_pages(n)
+
+    def work():
+        batch = RecordBatch.concat([RecordBatch.from_page(page)
+                                    for page in pages])
+        batch.datetimes()
+    return _loop(work)
+
+
+@benchmark('parse_staff_info')
+def bench_parse_staff_info(n):
+    ds = _dataset(n)
+    staff = ds.staff * (n // ds.users + 1)
+    pages = _pages(staff[:n * anviz.STAFF_SIZE], anviz.STAFF_SIZE, 12)
+
+    def work():
+        for page in pages:
+            parse_staff_info(page)
+    return _loop(work)
+
+
+@benchmark('frame_decoder')
+def bench_frame_decoder(n):
+    stream = b''.join(_frames(n))
+    chunks = [stream[i:i + 65536] for i in range(0, len(stream), 65536)]
+
+    def work():
+        decoder = FrameDecoder()
+        for chunk in chunks:
+            for frame in decoder.feed(chunk):
+                parse_record(frame.data)
+    return _loop(work)
+
+
+@benchmark('capture_replay')
+def bench_capture_replay(n):
+    path = tempfile.mkdtemp(prefix='anviz-bench-')
+    log = os.path.join(path, 'capture.log')
+    with CaptureWriter(log) as writer:
+        for page in _record_pages(n):
+            writer.write(1, CMD_DOWNLOAD_RECORDS, page, 'bench')
+    reader = CaptureReader(log)
+
+    def work():
+        for batch in reader.record_batches():
+            batch.datetimes()
+    run = _loop(work)
+
+    def close():
+        reader.close()
+        shutil.rmtree(path)
+    run.close = close
+    return run
+
+
+class _SQLite(object):
+    """Fresh SQLite database configured as the shared `db`."""
+
+    def __enter__(self):
+        from anviz_sync.models import configure_db
+        self.path = tempfile.mkdtemp(prefix='anviz-bench-')
+        configure_db('sqlite:///' + os.path.join(self.path, 'bench.db'))
+        return self
+
+    def __exit__(self, *exc_info):
+        from anviz_sync.models import db
+        db.session.remove()
+        shutil.rmtree(self.path)
+
+
+@benchmark('store_records', e2e=True)
+def bench_store_records(n):
+    from anviz_sync.sync import store_records
+    batches = [RecordBatch.from_page(page) for page in _record_pages(n)]
+
+    def run():
+        with _SQLite():
+            from anviz_sync.models import db
+            start = time.perf_counter()
+            store_records(batches, device='bench')
+            db.commit()
+            return time.perf_counter() - start
+    return run
+
+
+@benchmark('sync_sqlite', e2e=True)
+def bench_sync_sqlite(n):
+    from anviz_sync.config import DeviceConfig
+    from anviz_sync.sync import sync_device
+    sim = Simulator(1, dataset_options=dict(records=0))
+    sim.terminals[0].dataset = _dataset(n)
+    sim.start_background()
+    dev = DeviceConfig(name='bench', device_id=1, ip_addr=sim.host,
+                       ip_port=sim.terminals[0].port, timeout=30, retries=0,
+                       records_page=None, staff_page=None, pipeline=1,
+                       connect_timeout=10, keepalive=60)
+
+    def run():
+        with _SQLite():
+            start = time.perf_counter()
+            sync_device(dev)
+            return time.perf_counter() - start
+    run.close = lambda: (anviz.pool.close_all(), sim.stop_background())
+    return run
+
+
+@benchmark('rt_ingest', e2e=True)
+def bench_rt_ingest(n):
+    from anviz_sync.writer import RecordWriter
+    stream = b''.join(_frames(n))
+    chunks = [stream[i:i + 65536] for i in range(0, len(stream), 65536)]
+
+    def run():
+        with _SQLite():
+            start = time.perf_counter()
+            writer = RecordWriter(batch_size=500, interval=0.05)
+            writer.start()
+            decoder = FrameDecoder()
+            for chunk in chunks:
+                for frame in decoder.feed(chunk):
+                    writer.put(str(frame.device_id), parse_record(frame.data))
+            writer.stop()
+            return time.perf_counter() - start
+    return run
+
+
+def run_suite(sizes, repeat=5, max_e2e=100000, select=None,
+              stream=sys.stdout):
+    """Runs the registered benchmarks, returns a dict mapping
+    ``name/size`` to the best elapsed seconds of `repeat` runs.
+
+    End to end benchmarks only run up to `max_e2e` records, `select`
+    restricts the run to benchmark names containing any of its strings.
+    """
+    results = {}
+    for name, func, e2e in BENCHMARKS:
+        if select and not any(s in name for s in select):
+            continue
+        for n in sizes:
+            if e2e and n > max_e2e:
+                continue
+            run = func(n)
+            try:
+                best = min(run() for _ in range(repeat))
+            finally:
+                if hasattr(run, 'close'):
+                    run.close()
+            key = '%s/%d' % (name, n)
+            results[key] = best
+            stream.write("%-28s %10.4fs %9.3f us/record\n" %
+                         (key, best, best / n * 1e6))
+            stream.flush()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns ``(key, base, current, ratio, regressed)`` for every result
+    also found in `baseline`.
+    """
+    rows = []
+    for key, current in sorted(results.items()):
+        base = baseline.get(key)
+        if base:
+            ratio = current / base
+            rows.append((key, base, current, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def _size(value):
+    value = value.strip().lower()
+    scale = {'k': 1000, 'm': 1000000}.get(value[-1:], 1)
+    return int(value.rstrip('km')) * scale
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.suite')
+    parser.add_argument('--sizes', default='1k,100k,1m',
+                        help='comma separated record counts')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-e2e', type=_size, default=100000,
+                        help='largest size for end to end benchmarks, '
+                             'a device holds about 100k records')
+    parser.add_argument('--only', action='append',
+                        help='run benchmarks whose name contains this')
+    parser.add_argument('--output', help='write results as JSON here')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown against the baseline')
+    args = parser.parse_args(argv)
+
+    sizes = [_size(s) for s in args.sizes.split(',')]
+    results = run_suite(sizes, args.repeat, args.max_e2e, args.only)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created': datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'numpy': anviz._numpy() is not None,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        rows = compare(results, baseline, args.threshold)
+        print("\n%-28s %10s %10s %7s" % ("benchmark", "baseline", "current",
+                                          "ratio"))
+        for key, base, current, ratio, regressed in rows:
+            print("%-28s %9.4fs %9.4fs %6.2fx%s" %
+                  (key, base, current, ratio,
+                   '  REGRESSED' if regressed else ''))
+        if any(row[-1] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,11 @@
 
+import re
 from setuptools import setup
-from anviz_sync import __version__
+
+# read the version without importing the package and its dependencies
+with open("anviz_sync/__init__.py") as init:
+    __version__ = re.search(r"^__version__ = '([^']+)'", init.read(),
+                            re.M).group(1)
 
 with open("README.rst") as readme:
     long_description = str(readme.read())
@@ -37,10 +42,13 @@ setup(
     install_requires=[
         'SQLAlchemy>=0.9.8',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     entry_points={
         'console_scripts': [
-            'anviz-sync = anviz_sync.sync:main'
-            'anviz-rt = anviz_sync.rt:main'
+            'anviz-sync = anviz_sync.cli:main',
+            'anviz-rt = anviz_sync.rt:main',
         ],
     },
 )
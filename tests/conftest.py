@@ -0,0 +1,49 @@
+import pytest
+
+from anviz_sync import anviz
+from anviz_sync.config import DeviceConfig
+from anviz_sync.models import configure_db, db
+from anviz_sync.simulator import Simulator
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    """The shared `db` configured on a fresh SQLite file."""
+    configure_db('sqlite:///%s' % (tmp_path / 'test.db'))
+    yield db
+    db.session.remove()
+
+
+@pytest.fixture
+def simulator():
+    """Starts simulated terminals, ``simulator(count, **dataset_options)``,
+    stopped with every pooled connection once the test is done.
+    """
+    started = []
+
+    def start(count=1, **dataset_options):
+        sim = Simulator(count, dataset_options=dataset_options)
+        started.append(sim.start_background())
+        return sim
+
+    yield start
+    anviz.pool.close_all()
+    for sim in started:
+        sim.stop_background()
+
+
+@pytest.fixture
+def device_config():
+    """``device_config(sim, index=0, **options)`` returns the
+    :class:`DeviceConfig` of terminal `index` of `sim`.
+    """
+    def make(sim, index=0, **options):
+        terminal = sim.terminals[index]
+        config = dict(name='sim%d' % terminal.device_id,
+                      device_id=terminal.device_id, ip_addr=sim.host,
+                      ip_port=terminal.port, timeout=10, retries=0,
+                      records_page=None, staff_page=None, pipeline=1,
+                      connect_timeout=5, keepalive=None)
+        config.update(options)
+        return DeviceConfig(**config)
+    return make
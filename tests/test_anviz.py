@@ -0,0 +1,107 @@
+"""
+    Protocol framing tests.
+"""
+import gc
+import warnings
+from datetime import datetime
+
+import pytest
+
+from anviz_sync import simulator as simulator_module
+from anviz_sync.anviz import (
+    CMD_DOWNLOAD_RECORDS, RECORD_SIZE, Device, DeviceException, FrameDecoder,
+    parse_record
+)
+from anviz_sync.simulator import build_response, pack_record
+
+
+def _frames(count, device_id=1):
+    return [build_response(device_id, CMD_DOWNLOAD_RECORDS,
+                           pack_record(code, datetime(2024, 1, 1, 8, code)))
+            for code in range(count)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 7, 25, 1000])
+def test_decoder_chunking(size):
+    stream = b''.join(_frames(20))
+    decoder = FrameDecoder()
+    frames = []
+    for i in range(0, len(stream), size):
+        frames.extend(decoder.feed(stream[i:i + size]))
+    assert [parse_record(f.data).code for f in frames] == list(range(20))
+    assert decoder.pending == 0
+    assert decoder.corrupt == decoder.dropped_bytes == 0
+
+
+def test_decoder_resyncs_after_corrupt_frame():
+    frames = _frames(3)
+    bad = bytearray(frames[1])
+    bad[-1] ^= 0xff
+    decoder = FrameDecoder()
+    decoded = decoder.feed(b'junk' + frames[0] + bytes(bad) + frames[2])
+    assert [parse_record(f.data).code for f in decoded] == [0, 2]
+    assert decoder.corrupt == 1
+    assert decoder.pending == 0
+
+
+@pytest.mark.parametrize('garbage', [
+    # stray STX with a plausible length
+    b'\xa5\x00\x00\x00\x01\xc0\x00\x00\xff',
+    # stray STX with a record sized length
+    b'\xa5\x00\x00\x00\x01\xc0\x00\x00\x0e',
+    # ack byte without the ACK_sum bit
+    b'\xa5\x00\x00\x00\x01\x10\x00\x00\x05',
+])
+def test_decoder_stray_stx(garbage):
+    decoder = FrameDecoder(max_length=RECORD_SIZE)
+    decoded = decoder.feed(garbage)
+    for frame in _frames(5):
+        decoded.extend(decoder.feed(frame))
+    assert len(decoded) == 5
+    assert decoder.pending == 0
+
+
+def test_device_close_releases_socket(simulator):
+    sim = simulator()
+    terminal = sim.terminals[0]
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always', ResourceWarning)
+        with Device(terminal.device_id, sim.host, terminal.port) as clock:
+            clock.get_datetime()
+        assert not clock.connected
+        del clock
+        gc.collect()
+    assert not [w for w in caught if w.category is ResourceWarning]
+
+
+def test_device_reconnects_after_close(simulator):
+    sim = simulator()
+    terminal = sim.terminals[0]
+    clock = Device(terminal.device_id, sim.host, terminal.port)
+    with clock:
+        clock.get_datetime()
+    clock.get_datetime()
+    assert clock.connected
+    clock.close()
+
+
+def test_device_resets_after_rejected_header(simulator, monkeypatch):
+    sim = simulator()
+    terminal = sim.terminals[0]
+    build = simulator_module.build_response
+    replies = []
+
+    def wrong_ack(device_id, cmd, payload=b'', ret=0):
+        # the first response acknowledges another command
+        replies.append(cmd)
+        if len(replies) == 1:
+            cmd += 1
+        return build(device_id, cmd, payload, ret)
+
+    monkeypatch.setattr(simulator_module, 'build_response', wrong_ack)
+    clock = Device(terminal.device_id, sim.host, terminal.port)
+    with pytest.raises(DeviceException):
+        clock.get_net_params()
+    # the unread payload was dropped with the connection
+    assert clock.get_net_params().ip == '192.168.1.20'
+    clock.close()
@@ -0,0 +1,78 @@
+"""
+    Capture log tests.
+"""
+import pytest
+
+from anviz_sync.anviz import CMD_DOWNLOAD_RECORDS, CMD_GET_RECORD_INFO
+from anviz_sync.capture import CaptureError, CaptureReader, CaptureWriter
+from anviz_sync.simulator import Dataset
+
+
+def _page(dataset, start, count):
+    size = len(dataset.records) // dataset.record_count
+    return bytes([count]) + bytes(
+        dataset.records[start * size:(start + count) * size])
+
+
+def _write(path, pages, source='front'):
+    with CaptureWriter(path) as writer:
+        writer.write(1, CMD_GET_RECORD_INFO, b'\x00' * 18, source)
+        for page in pages:
+            writer.write(1, CMD_DOWNLOAD_RECORDS, page, source)
+
+
+def test_replay_records(tmp_path):
+    dataset = Dataset(records=50, users=5, seed=1)
+    path = str(tmp_path / 'capture.log')
+    _write(path, [_page(dataset, 0, 25), _page(dataset, 25, 25)])
+    with CaptureReader(path) as reader:
+        assert len(list(reader.entries())) == 3
+        assert sum(len(b) for b in reader.record_batches()) == 50
+        assert len(list(reader.records(source='back'))) == 0
+
+
+def test_sources_share_device_id(tmp_path):
+    # terminals left at the factory default id stay apart
+    dataset = Dataset(records=50, users=5, seed=1)
+    path = str(tmp_path / 'capture.log')
+    _write(path, [_page(dataset, 0, 25)], source='front')
+    _write(path, [_page(dataset, 25, 20)], source='back')
+    with CaptureReader(path) as reader:
+        assert reader.sources() == ['back', 'front']
+        assert len(list(reader.records(source='front'))) == 25
+        assert set(s for s, r in reader.records(source='back')) == {'back'}
+        assert sum(len(b) for b in reader.record_batches('back')) == 20
+
+
+def test_replay_without_path(capsys):
+    from anviz_sync import cli
+    assert cli.dump(['--replay']) == 2
+    assert 'usage' in capsys.readouterr().err
+
+
+def test_torn_tail(tmp_path):
+    dataset = Dataset(records=50, users=5, seed=1)
+    path = str(tmp_path / 'capture.log')
+    _write(path, [_page(dataset, 0, 25), _page(dataset, 25, 25)])
+    with open(path, 'r+b') as f:
+        f.seek(-10, 2)
+        f.truncate()
+
+    with CaptureReader(path) as reader:
+        assert sum(len(b) for b in reader.record_batches()) == 25
+    # reopening for writing truncates the torn entry
+    _write(path, [_page(dataset, 25, 25)])
+    with CaptureReader(path) as reader:
+        assert sum(len(b) for b in reader.record_batches()) == 50
+
+
+def test_corrupt_entry(tmp_path):
+    dataset = Dataset(records=50, users=5, seed=1)
+    path = str(tmp_path / 'capture.log')
+    _write(path, [_page(dataset, 0, 25), _page(dataset, 25, 25)])
+    with open(path, 'r+b') as f:
+        f.seek(60)
+        f.write(b'\xff')
+    with CaptureReader(path) as reader:
+        with pytest.raises(CaptureError):
+            list(reader.entries())
@@ -0,0 +1,38 @@
+"""
+    Device inventory tests.
+"""
+from configparser import ConfigParser
+
+import pytest
+
+from anviz_sync.config import load_devices
+
+INVENTORY = """
+[anviz:front]
+device_id = 1
+ip_addr = 10.0.0.10
+ip_port = 5010
+records_page = %s
+
+[sync]
+workers = 4
+"""
+
+
+def _config(records_page):
+    config = ConfigParser()
+    config.read_string(INVENTORY % records_page)
+    return config
+
+
+def test_load_devices():
+    devices = load_devices(_config(100))
+    assert [dev.name for dev in devices] == ['front']
+    assert devices[0].records_page == 100
+    assert devices[0].staff_page is None
+
+
+@pytest.mark.parametrize('records_page', [0, 256, -1])
+def test_page_size_fits_in_a_byte(records_page):
+    with pytest.raises(ValueError):
+        load_devices(_config(records_page))
@@ -0,0 +1,46 @@
+"""
+    Protocol only entry points must start fast, without the database layer.
+"""
+import subprocess
+import sys
+
+import pytest
+
+PROTOCOL_MODULES = ['anviz_sync.anviz', 'anviz_sync.cli', 'anviz_sync.config',
+                    'anviz_sync.rt']
+
+_probe = """
+import sys, time
+start = time.perf_counter()
+import %s
+print(time.perf_counter() - start, 'sqlalchemy' in sys.modules)
+"""
+
+
+def _import_time(module, repeat=3):
+    """Returns ``(best seconds, imports sqlalchemy)`` importing `module`
+    in fresh interpreters, see ``benchmarks/bench_import.py``.
+    """
+    best = None
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c',
+                                       _probe % module])
+        elapsed, loaded = out.split()
+        if best is None or float(elapsed) < best:
+            best = float(elapsed)
+    return best, loaded == b'True'
+
+
+@pytest.fixture(scope='module')
+def sqlalchemy_import_time():
+    return _import_time('sqlalchemy')[0]
+
+
+@pytest.mark.parametrize('module', PROTOCOL_MODULES)
+def test_import_time(module, sqlalchemy_import_time):
+    elapsed, loaded = _import_time(module)
+    assert not loaded
+    # importing SQLAlchemy alone takes longer than any of them, asyncio
+    # makes anviz_sync.rt the slowest at about two thirds of it. Timing
+    # relative to it keeps the check meaningful on slow machines.
+    assert elapsed < sqlalchemy_import_time
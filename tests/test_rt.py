@@ -0,0 +1,72 @@
+"""
+    Realtime listener tests.
+"""
+import asyncio
+import socket
+
+from anviz_sync import rt
+from anviz_sync.anviz import RECORD_SIZE, parse_record
+from anviz_sync.models import AttendanceRecord
+from anviz_sync.simulator import Simulator
+from anviz_sync.writer import RecordWriter
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def _wait_listening(port, timeout=5):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            if loop.time() > deadline:
+                raise
+            await asyncio.sleep(0.01)
+        else:
+            writer.close()
+            return
+
+
+def _pushed(terminal):
+    records = terminal.dataset.records
+    return set((r.code, r.datetime) for r in (
+        parse_record(records[i:i + RECORD_SIZE])
+        for i in range(0, len(records), RECORD_SIZE)))
+
+
+def test_serve_stores_pushed_events(sqlite_db):
+    sim = Simulator(2, dataset_options=dict(records=0, users=1000))
+    names = dict((t.device_id, 'sim%d' % t.device_id)
+                 for t in sim.terminals)
+    writer = RecordWriter(batch_size=20, interval=0.05)
+    writer.start()
+    port = _free_port()
+
+    async def run():
+        server = asyncio.ensure_future(rt.serve('127.0.0.1', port,
+                                                writer=writer, names=names))
+        try:
+            await _wait_listening(port)
+            assert await sim.push('127.0.0.1', port, 50) == 100
+            # events in the same second for a user are one punch
+            expected = sum(len(_pushed(t)) for t in sim.terminals)
+            deadline = asyncio.get_event_loop().time() + 10
+            while writer.stored < expected:
+                assert not server.done()
+                assert asyncio.get_event_loop().time() < deadline
+                await asyncio.sleep(0.01)
+        finally:
+            server.cancel()
+
+    asyncio.run(run())
+    writer.stop(timeout=10)
+    for terminal in sim.terminals:
+        stored = AttendanceRecord.query.filter_by(
+            device=names[terminal.device_id])
+        assert set((r.user_code, r.datetime) for r in stored) == \
+            _pushed(terminal)
@@ -0,0 +1,100 @@
+"""
+    Schema migration and bulk insert tests.
+"""
+from datetime import datetime
+
+import pytest
+import sqlalchemy
+from sqlalchemy.dialects import mysql, postgresql
+
+from anviz_sync.models import AttendanceRecord, configure_db, db, insert_rows
+from anviz_sync.saw import _drop_unique, _narrow_columns, _widen_column
+
+# attendance_record as created before devices were tracked
+BASELINE_SCHEMA = """
+CREATE TABLE attendance_record (
+    id INTEGER NOT NULL PRIMARY KEY,
+    user_code INTEGER NOT NULL,
+    datetime DATETIME NOT NULL UNIQUE,
+    bkp_type INTEGER NOT NULL,
+    type_code INTEGER NOT NULL,
+    received DATETIME,
+    device VARCHAR
+)
+"""
+
+
+@pytest.mark.parametrize('dialect, kind, expected', [
+    (postgresql.dialect(), 'constraint',
+     'ALTER TABLE attendance_record DROP CONSTRAINT old_uq'),
+    (postgresql.dialect(), 'index', 'DROP INDEX old_uq'),
+    (mysql.dialect(), 'constraint',
+     'ALTER TABLE attendance_record DROP INDEX old_uq'),
+    (mysql.dialect(), 'index', 'DROP INDEX old_uq ON attendance_record'),
+])
+def test_drop_unique_ddl(dialect, kind, expected):
+    table = AttendanceRecord.__table__
+    ddl = _drop_unique(table, kind, 'old_uq', ['datetime'])
+    assert str(ddl.compile(dialect=dialect)).strip() == expected
+
+
+def test_drop_unique_leaves_model_table_alone():
+    table = AttendanceRecord.__table__
+    constraints, indexes = set(table.constraints), set(table.indexes)
+    _drop_unique(table, 'constraint', 'old_uq', ['datetime'])
+    _drop_unique(table, 'index', 'old_ix', ['datetime'])
+    assert set(table.constraints) == constraints
+    assert set(table.indexes) == indexes
+
+
+@pytest.mark.parametrize('dialect, expected', [
+    (postgresql.dialect(),
+     'ALTER TABLE attendance_record ALTER COLUMN user_code TYPE BIGINT'),
+    (mysql.dialect(),
+     'ALTER TABLE attendance_record MODIFY user_code BIGINT NOT NULL'),
+])
+def test_widen_column_ddl(dialect, expected):
+    column = AttendanceRecord.__table__.c.user_code
+    assert _widen_column(column, dialect) == expected
+
+
+def test_migrate_from_baseline(tmp_path):
+    uri = 'sqlite:///%s' % (tmp_path / 'baseline.db')
+    engine = sqlalchemy.create_engine(uri)
+    engine.execute(BASELINE_SCHEMA)
+    # left behind by an interrupted rebuild
+    engine.execute("CREATE TABLE attendance_record__migrate (id INTEGER)")
+    narrow = _narrow_columns(sqlalchemy.inspect(engine),
+                             AttendanceRecord.__table__)
+    assert [c.name for c in narrow] == ['user_code']
+    engine.execute("INSERT INTO attendance_record (user_code, datetime, "
+                   "bkp_type, type_code) VALUES (1, '2020-01-01 08:00:00', "
+                   "0, 0)")
+    engine.dispose()
+
+    configure_db(uri)
+    try:
+        inspector = sqlalchemy.inspect(db.engine)
+        assert inspector.get_unique_constraints('attendance_record') == []
+        indexes = set(ix['name'] for ix in
+                      inspector.get_indexes('attendance_record'))
+        assert 'ix_attendance_record_device_user_datetime' in indexes
+        assert AttendanceRecord.query.count() == 1
+        assert 'attendance_record__migrate' not in \
+            inspector.get_table_names()
+
+        # 40 bit user codes
+        code = 0xff00000001
+        insert_rows([(code, datetime(2020, 1, 3), 0, 0, None, 'a')])
+        db.commit()
+        assert AttendanceRecord.query.filter_by(user_code=code).count() == 1
+
+        # two users punching in the same second, twice
+        dt = datetime(2020, 1, 2, 8, 0)
+        rows = [(1, dt, 0, 0, None, 'a'), (2, dt, 0, 0, None, 'a')]
+        assert insert_rows(rows) == 2
+        assert insert_rows(rows) == 0
+        db.commit()
+        assert db.migrate() == []
+    finally:
+        db.session.remove()
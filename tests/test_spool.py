@@ -0,0 +1,64 @@
+"""
+    Realtime event spool tests.
+"""
+import os
+
+from anviz_sync.spool import ENTRY_SIZE, Spool
+
+
+def _record(i):
+    return i.to_bytes(14, 'big')
+
+
+def _fill(spool, count, start=0):
+    return [spool.append(1, _record(i), 1000.0 + i)
+            for i in range(start, start + count)]
+
+
+def test_read_only_synced_entries(tmp_path):
+    spool = Spool(str(tmp_path), segment_entries=10)
+    _fill(spool, 25)
+    # rotating synced the full segments, the last five wait for sync
+    assert spool.synced == 20
+    assert [e.seq for e in spool.read(0, 100)] == list(range(1, 21))
+    spool.sync()
+    entries = spool.read(18, 5)
+    assert [e.seq for e in entries] == [19, 20, 21, 22, 23]
+    assert entries[0].data == _record(18)
+    assert spool.read(25, 10) == []
+    spool.close()
+
+
+def test_ack_compacts_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_entries=10)
+    _fill(spool, 35)
+    spool.sync()
+    assert len(spool.segments()) == 4
+    spool.ack(25)
+    assert [first for first, _ in spool.segments()] == [21, 31]
+    assert spool.pending == 10
+    assert [e.seq for e in spool.read(spool.committed, 100)] == \
+        list(range(26, 36))
+    spool.close()
+
+
+def test_recover_truncates_torn_tail(tmp_path):
+    spool = Spool(str(tmp_path), segment_entries=100)
+    _fill(spool, 10)
+    spool.ack(4)
+    spool.close()
+    _, path = spool.segments()[-1]
+    with open(path, 'ab') as f:
+        f.write(b'\x00' * (ENTRY_SIZE // 2))
+
+    spool = Spool(str(tmp_path), segment_entries=100)
+    assert os.path.getsize(path) == 10 * ENTRY_SIZE
+    assert spool.committed == 4
+    assert spool.pending == 6
+    assert [e.seq for e in spool.read(spool.committed, 100)] == \
+        list(range(5, 11))
+    # appends continue the sequence in a new segment
+    assert _fill(spool, 2) == [11, 12]
+    spool.sync()
+    assert [e.seq for e in spool.read(10, 100)] == [11, 12]
+    spool.close()
@@ -0,0 +1,154 @@
+"""
+    Sync tests against simulated terminals.
+"""
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from anviz_sync import sync
+from anviz_sync.anviz import Device, RecordsInfo, parse_record_info
+from anviz_sync.models import AttendanceRecord, Staff, SyncState
+
+
+def test_record_info_counters():
+    data = b''.join(v.to_bytes(3, 'big')
+                    for v in (300, 0, 1, 2, 100000, 70000))
+    info = parse_record_info(data)
+    assert info.users == 300
+    assert info.all_records == 100000
+    assert info.new_records == 70000
+
+
+def _info(all_records, new_records):
+    return RecordsInfo(10, 0, 0, 0, all_records, new_records)
+
+
+LAST = datetime(2024, 1, 1, 8, 0)
+
+
+@pytest.mark.parametrize('state, info, force_all, expected', [
+    # first sync
+    (dict(), _info(100, 100), False, (False, None, 0)),
+    # new records match the records past the cursor
+    (dict(record_count=100), _info(110, 10), False, (True, None, 0)),
+    # new marks out of sync, everything older than the cursor is dropped
+    (dict(record_count=100), _info(110, 3), False, (False, LAST, 0)),
+    # device records erased
+    (dict(record_count=100), _info(20, 20), False, (False, None, 0)),
+    (dict(record_count=100), _info(110, 10), True, (False, None, 0)),
+    # interrupted full download
+    (dict(record_count=100, resume_offset=40), _info(110, 10), False,
+     (False, None, 40)),
+    # interrupted, then erased
+    (dict(record_count=100, resume_offset=40), _info(20, 20), False,
+     (False, None, 0)),
+])
+def test_plan_download(state, info, force_all, expected):
+    if 'record_count' in state:
+        state['last_datetime'] = LAST
+    state = SyncState(device='dev', **state)
+    assert sync.plan_download(state, info, force_all) == expected
+
+
+def test_sync_device(sqlite_db, simulator, device_config):
+    sim = simulator(records=3000, users=30)
+    dev = device_config(sim, pipeline=4)
+
+    assert sync.sync_device(dev) == (3000, 0)
+    assert AttendanceRecord.query.filter_by(device=dev.name).count() == 3000
+    assert Staff.query.filter_by(device=dev.name).count() == 30
+    state = SyncState.query.get(dev.name)
+    assert state.record_count == 3000
+    assert state.resume_offset == 0
+
+    # nothing new, only records past the cursor are considered
+    assert sync.sync_device(dev) == (0, 0)
+
+
+def test_sync_new_records(sqlite_db, simulator, device_config):
+    sim = simulator(records=500, users=10)
+    dev = device_config(sim)
+    sync.sync_device(dev)
+
+    dataset = sim.terminals[0].dataset
+    for code in range(1, 6):
+        dataset.add_record(code)
+    assert sync.sync_device(dev) == (5, 0)
+    assert AttendanceRecord.query.count() == 505
+    with Device(dev.device_id, dev.ip_addr, dev.ip_port) as clock:
+        assert clock.get_record_info().new_records == 0
+
+
+def test_sync_resumes_after_failure(sqlite_db, simulator, device_config,
+                                    monkeypatch):
+    sim = simulator(records=2000, users=10)
+    dev = device_config(sim)
+    insert_rows = sync.insert_rows
+    calls = []
+
+    def failing(rows):
+        calls.append(len(rows))
+        if len(calls) == 3:
+            raise OperationalError('INSERT', {}, Exception('disk I/O'))
+        return insert_rows(rows)
+
+    monkeypatch.setattr(sync, 'insert_rows', failing)
+    result = sync._run_job(dev, False, False)
+    assert result.error is not None
+    # every chunk before the failure was committed with its checkpoint
+    offset = SyncState.query.get(dev.name).resume_offset
+    assert offset == AttendanceRecord.query.count() > 0
+
+    # stored records are skipped before reaching the database
+    assert sync.sync_device(dev) == (2000 - offset, 0)
+    assert AttendanceRecord.query.count() == 2000
+
+
+def test_run_job_retries_db_errors(sqlite_db, simulator, device_config,
+                                   monkeypatch):
+    sim = simulator(records=100, users=10)
+    dev = device_config(sim, retries=1)
+    insert_rows = sync.insert_rows
+    failures = [OperationalError('INSERT', {}, Exception('locked'))]
+
+    def flaky(rows):
+        if failures:
+            raise failures.pop()
+        return insert_rows(rows)
+
+    monkeypatch.setattr(sync, 'insert_rows', flaky)
+    monkeypatch.setattr(sync.time, 'sleep', lambda seconds: None)
+    result = sync._run_job(dev, False, False)
+    assert result.error is None
+    assert result.inserted == 100
+
+
+def test_sync_isolates_malformed_device(sqlite_db, simulator, tmp_path,
+                                        monkeypatch):
+    sim = simulator(2, records=100, users=5)
+    # the first terminal sends truncated pages
+    page = sim.terminals[0]._page
+    sim.terminals[0]._page = lambda *args: page(*args)[:-3]
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sync.time, 'sleep', lambda seconds: None)
+    (tmp_path / 'anviz-sync.ini').write_text(
+        sim.config() + '[sqlalchemy]\nuri = sqlite:///%s\n' %
+        (tmp_path / 'test.db'))
+
+    results = sync.sync()
+    assert [r.error is None for r in results] == [False, True]
+    assert 'Expected' in str(results[0].error)
+    assert results[1].inserted == 100
+
+
+def test_run_job_reports_unexpected_errors(sqlite_db, simulator,
+                                           device_config, monkeypatch):
+    sim = simulator(records=10, users=1)
+
+    def broken(*args):
+        raise RuntimeError('bug')
+
+    monkeypatch.setattr(sync, 'sync_device', broken)
+    result = sync._run_job(device_config(sim, retries=3), False, False)
+    assert isinstance(result.error, RuntimeError)
@@ -0,0 +1,92 @@
+"""
+    Realtime writer tests.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from anviz_sync import writer as writer_module
+from anviz_sync.anviz import parse_record
+from anviz_sync.models import AttendanceRecord
+from anviz_sync.simulator import pack_record
+from anviz_sync.spool import Spool
+from anviz_sync.writer import RecordWriter, SpoolDrain
+
+START = datetime(2024, 1, 1, 8, 0)
+
+
+def _raw(i):
+    return pack_record(i + 1, START + timedelta(minutes=i))
+
+
+def _failing_on(code, error):
+    # stores events unless the batch holds the record with `code`
+    store_events = writer_module.store_events
+
+    def store(events):
+        events = list(events)
+        if any(record.code == code for _, record, _ in events):
+            raise error
+        return store_events(events)
+    return store
+
+
+def test_writer_stores_in_groups(sqlite_db):
+    writer = RecordWriter(batch_size=10, interval=0.05)
+    writer.start()
+    for i in range(25):
+        writer.put('front', parse_record(_raw(i)))
+    writer.stop(timeout=10)
+    assert writer.stored == 25
+    assert 3 <= writer.commits <= 25
+    assert AttendanceRecord.query.filter_by(device='front').count() == 25
+
+
+def test_writer_retries_transient_errors(sqlite_db, monkeypatch):
+    store_events = writer_module.store_events
+    failures = [OperationalError('INSERT', {}, Exception('locked'))]
+
+    def flaky(events):
+        if failures:
+            raise failures.pop()
+        return store_events(events)
+
+    monkeypatch.setattr(writer_module, 'store_events', flaky)
+    writer = RecordWriter(batch_size=10, interval=0.01)
+    writer.start()
+    for i in range(5):
+        writer.put('front', parse_record(_raw(i)))
+    writer.stop(timeout=10)
+    assert writer.stored == 5
+    assert writer.dropped == 0
+
+
+def test_writer_drops_only_failing_events(sqlite_db, monkeypatch):
+    error = IntegrityError('INSERT', {}, Exception('duplicate'))
+    monkeypatch.setattr(writer_module, 'store_events', _failing_on(7, error))
+    writer = RecordWriter(batch_size=20, interval=0.05)
+    writer.start()
+    for i in range(20):
+        writer.put('front', parse_record(_raw(i)))
+    writer.stop(timeout=10)
+    assert writer.dropped == 1
+    assert writer.stored == 19
+    assert AttendanceRecord.query.filter_by(user_code=7).count() == 0
+
+
+def test_spool_drain(sqlite_db, tmp_path, monkeypatch):
+    error = IntegrityError('INSERT', {}, Exception('duplicate'))
+    monkeypatch.setattr(writer_module, 'store_events', _failing_on(3, error))
+    spool = Spool(str(tmp_path / 'spool'), segment_entries=10)
+    for i in range(30):
+        spool.append(1, _raw(i), 1000.0 + i)
+    spool.sync()
+
+    drain = SpoolDrain(spool, {1: 'front'}, batch_size=8, interval=0.01)
+    drain.start()
+    drain.stop(timeout=10)
+    assert not drain.is_alive()
+    # the failing event is dropped, the drain moves past it
+    assert AttendanceRecord.query.filter_by(device='front').count() == 29
+    assert spool.pending == 0
+    spool.close()